@@ -1,20 +1,19 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
 import os
-import ipaddress
 import logging
-import socket
-import urllib.request
+import mimetypes
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from urllib.parse import urlparse
-import filetype
-from bson import ObjectId
-from flask import Flask, jsonify, request, send_from_directory, Response, g, send_file
+from gridfs.errors import FileExists
+from flask import Blueprint, Flask, jsonify, request, Response, g, send_file
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
-from PIL import Image, ImageOps, UnidentifiedImageError
+from PIL import Image, UnidentifiedImageError
 from flask_apscheduler import APScheduler
 
 # add the parent directory to the path
@@ -22,72 +21,125 @@ myDir = os.getcwd()
 sys.path.append(myDir)
 
 import imgpush.settings as settings
-from imgpush.lib.utils import pil_to_file, pil_to_binary, get_size_from_string
-from imgpush.lib.resize_image import resize_image
-from imgpush.lib.remove_metadata import remove_metadata
-from imgpush.lib.filename import get_random_filename
-from imgpush.lib.errors import CollisionError, InvalidSize
-from imgpush.lib.convert_format import convert_format_type, convert_image
-from imgpush.lib.autodel_cache import autodel_cache
+from imgpush.lib.utils import get_size_from_string, atomic_write
+from imgpush.lib.resize_pool import resize_pool
+from imgpush.lib.single_flight import single_flight, file_lock
+from imgpush.lib.pregenerate import is_pregenerated, delete_variants
+from imgpush.lib.upload import SpooledRequest, store_upload
+from imgpush.lib.fetch import fetcher
+from imgpush.lib.filename import get_random_filename, get_resized_filename, get_shard_path, find_path
+from imgpush.lib.errors import FetchError, FetchRejected, InvalidSize, ResizeQueueFull, ResizeTimeout
+from imgpush.lib.convert_format import negotiate_format
+from imgpush.lib.autodel_cache import autodel_cache, record_cache_access, record_cache_write
 from imgpush.lib.jwt import verify
-from imgpush.lib.db import fs, cachefs
-from imgpush.lib.migrate.file_to_mongo import file_to_mongo
-from imgpush.lib.migrate.mongo_to_file import mongo_to_file
+from imgpush.lib import dedup, metrics, mmap_storage
+from imgpush.lib.db import fs, cachefs, variantsfs, ensure_indexes, find_file
+from imgpush.lib.stream import stream_gridout
+from imgpush.lib.memory_cache import memory_cache
+from imgpush.lib.conditional import add_cache_headers, is_not_modified, not_modified
+from imgpush.lib.migrate.migrate import check_marker
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app)
-app.logger.setLevel(logging.INFO)
+# not known to older mimetypes databases, needed to serve negotiated formats
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/webp", ".webp")
+
+bp = Blueprint("imgpush", __name__)
 
 # initialize scheduler
 scheduler = APScheduler()
 
-# add configuration values
-app.config['SCHEDULER_API_ENABLED'] = True
-
 @scheduler.task('interval', id='autodel_cache', seconds=60)
 def job1():
     autodel_cache()
 
-# add the scheduler to the app
-scheduler.init_app(app)
-scheduler.start()
-
 use_mongo: bool = settings.USE_MONGO
-if use_mongo:
-    logger.info("Using mongodb gridfs for storage")
-else:
-    logger.info("Using local filesystem for storage")
 
-CORS(app, origins=settings.ALLOWED_ORIGINS)
-app.config["MAX_CONTENT_LENGTH"] = settings.MAX_SIZE_MB * 1024 * 1024
-limiter = Limiter(app, default_limits=[])
+limiter = Limiter(get_remote_address, default_limits=[],
+                  storage_uri=settings.RATE_LIMIT_STORAGE_URI or mmap_storage.default_uri())
+
+batch_executor = ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS, thread_name_prefix="batch-upload")
 
-app.USE_X_SENDFILE = True
+# pid of the process that started the background work
+_started_pid = None
+_start_lock = threading.Lock()
 
-@app.before_request
-def before_request():
+
+def create_app() -> Flask:
     """
-    The before_request function is called before the request handler function.
-    It sets g.user to the user object if a valid authorization header is provided,
-    otherwise it sets g.user to None.
+    The create_app function creates the imgpush app. It neither connects to
+    mongodb nor starts the scheduler, so importing imgpush and preloading the
+    app before forking workers stays cheap. That work is done by start_background
+    on the first request of every worker process.
 
-    :return: The user object if a valid token is
-    :doc-author: Trelent
+    :return: The app
     """
-    try:
-        user = verify(request.headers.get('Authorization')[7:])
-        if user:
-            g.user = user
-        else:
-            g.user = None
-    except Exception:
-        g.user = None
+    app = Flask(__name__)
+    app.request_class = SpooledRequest
+    app.wsgi_app = ProxyFix(app.wsgi_app)
+    app.logger.setLevel(logging.INFO)
+
+    # add configuration values
+    app.config['SCHEDULER_API_ENABLED'] = True
+    app.config["MAX_CONTENT_LENGTH"] = settings.MAX_SIZE_MB * 1024 * 1024
+    app.USE_X_SENDFILE = True
+
+    # add the scheduler to the app, it is started by start_background
+    scheduler.init_app(app)
+    CORS(app, origins=settings.ALLOWED_ORIGINS)
+    # registered before the limiter, so rejected requests are timed too
+    app.before_request(start_timer)
+    limiter.init_app(app)
+    app.before_request(start_background)
+    app.register_blueprint(bp)
+
+    if use_mongo:
+        logger.info("Using mongodb gridfs for storage")
+    else:
+        logger.info("Using local filesystem for storage")
+    check_marker("mongo" if use_mongo else "file")
+    return app
+
+
+def start_background():
+    """
+    The start_background function starts the scheduler and creates the mongodb
+    indexes, once per process. Threads do not survive a fork, so it runs on the
+    first request of each worker instead of at import.
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        if use_mongo:
+            threading.Thread(target=ensure_indexes, name="ensure-indexes", daemon=True).start()
+        scheduler.start()
+
+
+def start_timer():
+    g.request_start = time.perf_counter()
 
 
-@app.after_request
+def get_user() -> dict | None:
+    """
+    The get_user function returns the claims of the bearer token of the request.
+    The token is verified the first time a route asks for the user, so routes
+    that do not require authentication never verify it.
+
+    :return: The claims if a valid token is provided, otherwise None
+    """
+    if "user" not in g:
+        authorization = request.headers.get("Authorization")
+        g.user = verify(authorization[7:]) if authorization else None
+    return g.user
+
+
+@bp.after_app_request
 def after_request(resp):
     """
     The after_request function is a Flask decorator that modifies the response
@@ -104,10 +156,39 @@ def after_request(resp):
         resp.headers["X-Accel-Redirect"] = "/nginx/" + x_sendfile
         del resp.headers["X-Sendfile"]
     resp.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
+    if g.get("etag") and resp.status_code in (200, 206):
+        add_cache_headers(resp, g.etag, g.last_modified)
+    if "request_start" in g:
+        metrics.observe_request(request.endpoint, resp.status_code, time.perf_counter() - g.request_start)
+    return resp
+
+
+@bp.app_errorhandler(ResizeQueueFull)
+def resize_queue_full(_error):
+    """
+    The resize_queue_full function answers with 503 when every resize worker
+    is busy and the resize queue is full, asking the client to retry later.
+
+    :return: A json object containing the error
+    """
+    resp = jsonify(error="Too many images are being resized, try again later")
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(settings.RESIZE_TIMEOUT)
     return resp
 
 
-@app.route("/", methods=["GET"])
+@bp.app_errorhandler(ResizeTimeout)
+def resize_timeout(_error):
+    """
+    The resize_timeout function answers with 500 when resizing an image
+    took longer than RESIZE_TIMEOUT and its worker was killed.
+
+    :return: A json object containing the error
+    """
+    return jsonify(error="Resizing the image timed out"), 500
+
+
+@bp.route("/", methods=["GET"])
 def root():
     """
     The root function returns a string containing the HTML for an upload form.
@@ -125,7 +206,7 @@ def root():
 """
 
 
-@app.route("/liveness", methods=["GET"])
+@bp.route("/liveness", methods=["GET"])
 def liveness():
     """
     The liveness function is used to determine if the server is still alive.
@@ -137,17 +218,56 @@ def liveness():
     return Response(status=200)
 
 
-@app.route(settings.UPLOAD_ROUTE, methods=["POST"])
-@limiter.limit(
-    "".join(
-        [
-            f"{settings.MAX_UPLOADS_PER_DAY}/day;",
-            f"{settings.MAX_UPLOADS_PER_HOUR}/hour;",
-            f"{settings.MAX_UPLOADS_PER_MINUTE}/minute",
-        ]
-    ),
-    key_func=lambda: f"user{g.get('user')['id']}" if g.get("user") else get_remote_address()
+@bp.route("/stats", methods=["GET"])
+def stats():
+    """
+    The stats function returns the hit, miss and eviction counters of the
+    in-memory image cache, which can be used to size MEMORY_CACHE_SIZE_MB.
+
+    :return: A json object containing the cache statistics
+    """
+    return jsonify(memory_cache=memory_cache.stats())
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    The metrics_endpoint function returns the request counts, latency histograms
+    and cache counters of all the worker processes in the Prometheus text format.
+
+    :return: The metrics, as text
+    """
+    if settings.DISABLE_METRICS:
+        return jsonify(error="Not found"), 404
+    return Response(metrics.registry.expose(), mimetype="text/plain; version=0.0.4")
+
+
+UPLOAD_LIMITS = "".join(
+    [
+        f"{settings.MAX_UPLOADS_PER_DAY}/day;",
+        f"{settings.MAX_UPLOADS_PER_HOUR}/hour;",
+        f"{settings.MAX_UPLOADS_PER_MINUTE}/minute",
+    ]
 )
+
+
+def upload_key() -> str:
+    return f"user{get_user()['id']}" if get_user() else get_remote_address()
+
+
+def batch_size() -> int:
+    """
+    The batch_size function counts the images of a batch upload, so that each
+    of them is counted against the upload limits.
+
+    :return: The number of images in the request, at least 1
+    """
+    urls = (request.get_json(silent=True) or {}).get("urls")
+    return max(len(request.files.getlist("file")) + (len(urls) if isinstance(urls, list) else 0), 1)
+
+
+@bp.route(settings.UPLOAD_ROUTE, methods=["POST"])
+@limiter.shared_limit(UPLOAD_LIMITS, scope="upload", key_func=upload_key)
 def upload_image():
     """
     The upload_image function is used to upload an image file to the server.
@@ -159,68 +279,91 @@ def upload_image():
     """
     if (
         settings.UPLOAD_REQUIRE_AUTH is True
-        and not g.get("user")
+        and not get_user()
     ):
         return jsonify(error="Unauthorized"), 401
 
-    random_string = get_random_filename()
-    tmp_filepath = os.path.join("/tmp/", random_string)
-
     if "file" in request.files:
-        file = request.files["file"]
-        file.save(tmp_filepath)
+        result, status = upload_item(request.files["file"].stream, None, request.host_url)
     elif settings.DISABLE_URL_UPLOAD is not True and "url" in request.json:
-        if request.json["url"].lower().startswith('http'):
-            ip: (ipaddress.IPv4Address | ipaddress.IPv6Address) = None
-            try:
-                ip = ipaddress.ip_address(socket.gethostbyname(urlparse(request.json["url"]).netloc))
-            except Exception:
-                return jsonify(error="Failed to resolve host"), 400
-            if ip.is_private or ip.is_loopback or ip.is_link_local:
-                return jsonify(error="Refusing to connect to local or private address"), 400
-            try:
-                urllib.request.urlretrieve(request.json["url"], tmp_filepath)
-            except:
-                return jsonify(error="Failed to download file"), 500
-        else:
-            return jsonify(error="Invalid URL"), 400
+        result, status = upload_item(None, request.json["url"], request.host_url)
     else:
         return jsonify(error="File is missing!"), 400
 
-    output_type = settings.OUTPUT_TYPE or filetype.guess_extension(tmp_filepath)
-    error = None
+    return jsonify(result), status
+
+
+@bp.route(settings.BATCH_UPLOAD_ROUTE, methods=["POST"])
+@limiter.shared_limit(UPLOAD_LIMITS, scope="upload", key_func=upload_key, cost=batch_size)
+def batch_upload():
+    """
+    The batch_upload function uploads several images in one request, either as
+    multiple file fields or as a json list of urls. The images are processed
+    concurrently and every one of them counts against the upload limits.
+
+    :return: A json object containing the result or error of every image, in order
+    """
+    if (
+        settings.UPLOAD_REQUIRE_AUTH is True
+        and not get_user()
+    ):
+        return jsonify(error="Unauthorized"), 401
+
+    items = [(file.stream, None) for file in request.files.getlist("file")]
+    if settings.DISABLE_URL_UPLOAD is not True:
+        urls = (request.get_json(silent=True) or {}).get("urls") or []
+        if not isinstance(urls, list):
+            return jsonify(error="urls must be a list"), 400
+        items += [(None, url) for url in urls]
+
+    if not items:
+        return jsonify(error="File is missing!"), 400
+    if len(items) > settings.MAX_BATCH_SIZE:
+        for stream, _url in items:
+            if stream:
+                stream.close()
+        return jsonify(error=f"At most {settings.MAX_BATCH_SIZE} images can be uploaded at once"), 400
+
+    host_url = request.host_url
+    results = batch_executor.map(lambda item: upload_item(*item, host_url), items)
+    return jsonify(results=[dict(result, status=status) for result, status in results]), 200
 
-    output_filename = os.path.basename(tmp_filepath) + f".{output_type.lower()}"
-    output_path = os.path.join(settings.IMAGES_DIR, output_filename)
+
+def upload_item(stream, url: str | None, host_url: str) -> tuple[dict, int]:
+    """
+    The upload_item function stores one uploaded file, or downloads and stores
+    the image at url. It does not need a request context, so batch uploads can
+    run it on worker threads.
+
+    :param stream: The uploaded file, or None for a url upload
+    :param url: str | None: The url of the image to download
+    :param host_url: str: The url of this server, to build the url of the image
+    :return: The (result, status code) of the upload
+    """
+    if url is not None:
+        try:
+            stream = fetcher.fetch(url)
+        except FetchRejected as e:
+            return {"error": str(e)}, 400
+        except FetchError as e:
+            logger.info(f"Failed to download {url}: {e}")
+            return {"error": "Failed to download file"}, 500
 
     try:
-        if os.path.exists(output_path):
-            raise CollisionError
-        with Image.open(tmp_filepath) as img:
-            img = remove_metadata(img)
-            if use_mongo:
-                output_file = fs.put(pil_to_binary(img, output_type),
-                                     filename=output_filename, metadata={"type": f"image/{output_type}", "uploadDate": datetime.now()})
-                logger.info(f"Uploaded file {output_filename} with ObjectID({str(output_file)}) to GridFS")
-            else:
-                file_format = convert_format_type(output_type)
-                with convert_image(img, file_format) as converted:
-                    converted.save(output_path, format=file_format)
+        output_filename = store_upload(stream, get_random_filename())
     except UnidentifiedImageError:
-        error = "Invalid Filetype"
+        return {"error": "Invalid Filetype"}, 400
+    except Image.DecompressionBombError:
+        return {"error": "Image is too large"}, 400
     finally:
-        if os.path.exists(tmp_filepath):
-            os.remove(tmp_filepath)
-
-    if error:
-        return jsonify(error=error), 400
+        stream.close()
 
-    return jsonify(filename=output_filename,
-                   path=f"{settings.IMAGES_ROOT}/{output_filename}",
-                   url=f"{request.host_url[:-1]}{settings.IMAGES_ROOT}/{output_filename}"), 200
+    return {"filename": output_filename,
+            "path": f"{settings.IMAGES_ROOT}/{output_filename}",
+            "url": f"{host_url[:-1]}{settings.IMAGES_ROOT}/{output_filename}"}, 200
 
 
-@app.route(f"{settings.IMAGES_ROOT}/<string:filename>")
+@bp.route(f"{settings.IMAGES_ROOT}/<string:filename>")
 @limiter.exempt
 def get_image(filename):
     """
@@ -235,13 +378,11 @@ def get_image(filename):
     :return: The image with the given filename
     :doc-author: Trelent
     """
-    if settings.GET_REQUIRE_AUTH is True and not g.get("user"):
+    if settings.GET_REQUIRE_AUTH is True and not get_user():
         return jsonify(error="Unauthorized"), 401
     width = request.args.get("w", "")
     height = request.args.get("h", "")
 
-    path = os.path.join(settings.IMAGES_DIR, filename)
-
     try:
         width = get_size_from_string(width)
         height = get_size_from_string(height)
@@ -251,61 +392,200 @@ def get_image(filename):
             400,
         )
 
+    if settings.DISABLE_RESIZE is True:
+        width, height = "", ""
+    output_format = negotiate_format(filename, request.accept_mimetypes) if settings.NEGOTIATE_FORMATS else None
+    cache_key = (filename, width, height, output_format)
+    cached = memory_cache.get(cache_key)
+    if memory_cache.enabled:
+        metrics.record_cache("memory", cached is not None)
+    if cached:
+        data, mimetype, g.etag, g.last_modified = cached
+        if is_not_modified(g.etag, g.last_modified):
+            return not_modified(g.etag, g.last_modified)
+        return send_file(BytesIO(data), mimetype=mimetype)
+
+    # deduplicated images share the variants and resized images of their blob,
+    # on the filesystem an alias is a hard link that is served as it is
+    blob = None
+    if settings.DEDUPLICATE_UPLOADS and (use_mongo or width or height or output_format):
+        blob = dedup.canonical(filename)
+    source_filename = blob or filename
+
     if use_mongo:
         try:
-            if fs.exists({"filename": filename}) is False:
+            file = find_file(fs, dedup.blob_filename(blob) if blob else filename)
+            if file is None:
                 raise FileNotFoundError
-            fs_id = fs.find_one({"filename": filename})
-            file = fs.get(ObjectId(fs_id._id))
         except Exception as e:
             logger.error(e)
             return jsonify(error="File not found"), 404
 
-        if settings.DISABLE_RESIZE is True or not (width or height):
-            return send_file(BytesIO(file.read()), mimetype=str(file.metadata['type']))
+        set_validators(str(file._id), file.upload_date, width, height, output_format)
+        if is_not_modified(g.etag, g.last_modified):
+            return not_modified(g.etag, g.last_modified)
+
+        if not (width or height or output_format):
+            return send_gridout(cache_key, file, str(file.metadata['type']))
+
+        extension = f".{output_format}" if output_format else os.path.splitext(filename)[1]
+        mimetype = f"image/{output_format}" if output_format else str(file.metadata['type'])
+        resized_filename = get_resized_filename(source_filename, width, height, output_format)
+        if is_pregenerated(width, height) and not output_format:
+            variant = find_file(variantsfs, resized_filename)
+            metrics.record_cache("variants", variant is not None)
+            if variant is not None:
+                return send_gridout(cache_key, variant, mimetype)
+
+        cached_file = find_file(cachefs, resized_filename)
+        metrics.record_cache("resized", cached_file is not None)
+        if cached_file is None:
+            def create_resized_image():
+                with metrics.stage("storage_read"):
+                    source = file.read()
+                resized_binary = resize_pool.resize(source, width, height, extension[1:])
+                try:
+                    with metrics.stage("storage_write"):
+                        cachefs.put(resized_binary, filename=resized_filename,
+                                    metadata={"type": extension[1:], "uploadDate": datetime.now(),
+                                              "lastAccess": datetime.now()})
+                except FileExists:
+                    # another worker stored the same variant first
+                    pass
+                logger.info(f"Resized file {filename} to {width}x{height}, type: {mimetype}")
+                return resized_binary
 
-        dimensions = f"{width}x{height}"
-        filename_without_extension, extension = os.path.splitext(filename)
-        resized_filename = filename_without_extension + f"_{dimensions}{extension}"
-        if cachefs.exists({"filename": resized_filename}) is False:
             try:
-                resized_image = resize_image(Image.open(file), width, height)
-                cachefs.put(pil_to_binary(resized_image, convert_format_type(extension[1:])), filename=resized_filename, metadata={"type": extension[1:], "uploadDate": datetime.now()})
-                resized_image = pil_to_file(resized_image, convert_format_type(extension[1:]))
-                logger.info(f"Resized file {filename} to {width}x{height}, type: {file.metadata['type']}")
+                resized_binary = single_flight.do(resized_filename, create_resized_image)
+            except (ResizeQueueFull, ResizeTimeout):
+                raise
             except Exception as e:
                 logger.error(e)
                 return jsonify(error="Failed to resize image"), 500
-        else:
-            fs_id = cachefs.find_one({"filename": resized_filename})
-            resized_image = BytesIO(cachefs.get(ObjectId(fs_id._id)).read())
+            return send_cached(cache_key, resized_binary, mimetype)
 
-        return send_file(resized_image, file.metadata['type'])
+        record_cache_access(resized_filename)
+        return send_gridout(cache_key, cached_file, mimetype)
 
-    if settings.DISABLE_RESIZE is not True and ((width or height) and (os.path.isfile(path))):
-        dimensions = f"{width}x{height}"
-        filename_without_extension, extension = os.path.splitext(filename)
-        resized_filename = filename_without_extension + f"_{dimensions}{extension}"
-        resized_path = os.path.join(settings.CACHE_DIR, resized_filename)
+    path = find_path(settings.IMAGES_DIR, filename)
+    if path is None:
+        return jsonify(error="File not found"), 404
+
+    stat = os.stat(path)
+    set_validators(f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+                   datetime.fromtimestamp(stat.st_mtime, timezone.utc), width, height, output_format)
+    if is_not_modified(g.etag, g.last_modified):
+        return not_modified(g.etag, g.last_modified)
+
+    if width or height or output_format:
+        extension = f".{output_format}" if output_format else os.path.splitext(filename)[1]
+        resized_filename = get_resized_filename(source_filename, width, height, output_format)
+        if is_pregenerated(width, height) and not output_format:
+            variant_path = find_path(settings.VARIANTS_DIR, resized_filename)
+            metrics.record_cache("variants", variant_path is not None)
+            if variant_path:
+                return send_image_file(cache_key, variant_path)
+
+        resized_path = find_path(settings.CACHE_DIR, resized_filename)
+        metrics.record_cache("resized", resized_path is not None)
+        if resized_path is None:
+            resized_path = get_shard_path(settings.CACHE_DIR, resized_filename)
+
+            def create_resized_file():
+                with file_lock(resized_path):
+                    if os.path.isfile(resized_path):
+                        return
+                    resized_binary = resize_pool.resize(path, width, height, extension[1:])
+                    with metrics.stage("storage_write"):
+                        atomic_write(resized_path, resized_binary)
+                    record_cache_write(resized_filename, len(resized_binary))
+                    logger.info(f"Resized file {filename} to {width}x{height}, type: {extension[1:]}")
 
-        if not os.path.isfile(resized_path) and (width or height):
             try:
-                resized_image = resize_image(Image.open(path), width, height)
-                resized_image = ImageOps.exif_transpose(resized_image)
-                resized_image.save(resized_path, format=convert_format_type(extension[1:]))
-                resized_image.close()
-                logger.info(f"Resized file {filename} to {width}x{height}, type: {file.metadata['type']}")
+                single_flight.do(resized_path, create_resized_file)
+            except (ResizeQueueFull, ResizeTimeout):
+                raise
             except Exception as e:
                 logger.error(e)
                 return jsonify(error="Failed to resize image"), 500
-        return send_from_directory(settings.CACHE_DIR, resized_filename)
+        else:
+            record_cache_access(resized_filename)
+        return send_image_file(cache_key, resized_path)
 
-    return send_from_directory(settings.IMAGES_DIR, filename)
+    return send_image_file(cache_key, path)
 
 # https://github.com/hauxir/imgpush/pull/33
 
 
-@app.route(f"{settings.IMAGES_ROOT}/<string:filename>", methods=["DELETE"])
+def set_validators(etag: str, last_modified: datetime, width, height, output_format: str | None):
+    """
+    The set_validators function stores the ETag and Last-Modified of the
+    requested image in g. Resized and converted variants get their own ETag
+    derived from the original.
+
+    :param etag: str: The ETag of the original image
+    :param last_modified: datetime: When the original image was stored
+    :param width: The requested width, or ""
+    :param height: The requested height, or ""
+    :param output_format: str | None: The format the image is converted to
+    """
+    if width or height:
+        etag = f"{etag}-{width}x{height}"
+    if output_format:
+        etag = f"{etag}.{output_format}"
+    g.etag = etag
+    g.last_modified = last_modified
+
+
+def send_cached(key: tuple, data: bytes, mimetype: str):
+    """
+    The send_cached function stores the encoded image in the in-memory cache
+    and sends it to the client.
+
+    :param key: tuple: The (filename, width, height) cache key
+    :param data: bytes: The encoded image
+    :param mimetype: str: The mimetype of the image
+    :return: The response object
+    """
+    memory_cache.put(key, data, mimetype, g.get("etag"), g.get("last_modified"))
+    return send_file(BytesIO(data), mimetype=mimetype)
+
+
+def send_gridout(key: tuple, file, mimetype: str):
+    """
+    The send_gridout function sends a GridFS file, reading it into the
+    in-memory cache if it fits, and streaming it otherwise.
+
+    :param key: tuple: The (filename, width, height) cache key
+    :param file: GridOut: The GridFS file to send
+    :param mimetype: str: The mimetype of the image
+    :return: The response object
+    """
+    if memory_cache.accepts(file.length):
+        with metrics.stage("storage_read"):
+            data = file.read()
+        return send_cached(key, data, mimetype)
+    return stream_gridout(file, mimetype)
+
+
+def send_image_file(key: tuple, path: str):
+    """
+    The send_image_file function sends a file from the images, variants or cache
+    directory, reading it into the in-memory cache if it fits.
+
+    :param key: tuple: The (filename, width, height, format) cache key
+    :param path: str: The path of the file
+    :return: The response object
+    """
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if memory_cache.accepts(os.path.getsize(path)):
+        with metrics.stage("storage_read"), open(path, "rb") as fp:
+            data = fp.read()
+        return send_cached(key, data, mimetype)
+    return send_file(path, mimetype=mimetype)
+
+
+@bp.route(f"{settings.IMAGES_ROOT}/<string:filename>", methods=["DELETE"])
 def delete_image(filename):
     """
     The delete_image function deletes an image from the images directory.
@@ -315,30 +595,32 @@ def delete_image(filename):
     :return: A response object with status code 204
     :doc-author: Trelent
     """
-    if getattr(g.get("user"), "role", None) != "admin":
+    if (get_user() or {}).get("role") != "admin":
         return jsonify(error="Permission denied"), 403
+    memory_cache.invalidate(filename)
+    if settings.DEDUPLICATE_UPLOADS and dedup.release(filename):
+        return Response(status=204)
     if use_mongo:
         try:
-            if fs.exists({"filename": filename}):
-                fs.delete(fs.find_one({"filename": filename}))
-                return jsonify(success=True), 204
-            else:
+            file = find_file(fs, filename)
+            if file is None:
                 raise FileNotFoundError
+            fs.delete(file._id)
+            delete_variants(filename)
+            return jsonify(success=True), 204
         except Exception as e:
             logger.error(e)
             return jsonify(error="File not found"), 404
-    path = os.path.join(settings.IMAGES_DIR, filename)
-    if os.path.isfile(path):
+    path = find_path(settings.IMAGES_DIR, filename)
+    if path:
         os.remove(path)
+        delete_variants(filename)
     else:
         return jsonify(error="File not found"), 404
 
     return Response(status=204)
 
-if use_mongo:
-    file_to_mongo()
-else:
-    mongo_to_file()
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=settings.PORT, threaded=True, debug=settings.DEBUG)
@@ -0,0 +1,125 @@
+"""
+Measures the peak memory and the time of re-encoding, resizing and converting
+large animated GIFs with the previous pipeline, which copied every frame into
+a list before saving and resized only the first frame, and with the frame by
+frame pipeline.
+
+Every run happens in a forked process, so the peak RSS of one run does not
+hide the next.
+
+    python imgpush/benchmarks/animation.py
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+from io import BytesIO
+from multiprocessing import get_context
+from PIL import Image, ImageDraw
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+os.environ["MAX_ANIMATION_PIXELS"] = str(10 ** 12)
+from imgpush.lib.animation import GifWriter
+from imgpush.lib.resize_image import resize_image
+from imgpush.lib.resize_pool import _resize
+from imgpush.lib.utils import pil_to_binary
+
+SOURCES = [(100, (640, 480)), (300, (640, 480)), (200, (1280, 720))]
+TARGET_WIDTH = 320
+
+
+def make_gif(path: str, frames: int, size: tuple[int, int]):
+    # written with GifWriter, Pillow would hold every frame while saving
+    with open(path, "wb") as fp:
+        writer = GifWriter(fp, size, 0, False)
+        previous = None
+        for index in range(frames):
+            frame = Image.new("RGB", size, (20, 40, 80))
+            draw = ImageDraw.Draw(frame)
+            for ball in range(8):
+                x = (index * (ball + 3) * 7) % size[0]
+                y = (ball * size[1] // 8 + index * 5) % size[1]
+                draw.ellipse((x, y, x + size[0] // 8, y + size[0] // 8), fill=(255, 30 * ball, 255 - 30 * ball))
+            writer.add(frame, 40, previous)
+            previous = frame
+        writer.close()
+
+
+def legacy_frames(img: Image.Image) -> list:
+    frames = []
+    try:
+        while True:
+            img.seek(len(frames))
+            frames.append(img.copy())
+    except EOFError:
+        pass
+    return frames
+
+
+def legacy_encode(path: str, width) -> int:
+    """The previous pipeline: every frame copied into a list, then saved by Pillow."""
+    with Image.open(path) as img:
+        frames = legacy_frames(img)
+        if width:
+            # the previous resize only kept the first frame
+            frames = [resize_image(frames[0], width, "")]
+        buffer = BytesIO()
+        frames[0].save(buffer, save_all=True, append_images=frames[1:], format="GIF")
+        return len(buffer.getvalue())
+
+
+def legacy_resize_all(path: str, width) -> int:
+    """The previous pipeline extended to resize every frame, to compare like with like."""
+    with Image.open(path) as img:
+        frames = [resize_image(frame.convert("RGB"), width, "") for frame in legacy_frames(img)]
+        buffer = BytesIO()
+        frames[0].save(buffer, save_all=True, append_images=frames[1:], format="GIF")
+        return len(buffer.getvalue())
+
+
+def new_encode(path: str, width, file_format: str = "GIF") -> int:
+    if width:
+        return len(_resize(path, width, "", file_format))
+    with Image.open(path) as img:
+        return len(pil_to_binary(img, file_format))
+
+
+def measure(fn, args: tuple, conn):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    size = fn(*args)
+    elapsed = time.perf_counter() - start
+    conn.send((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss, elapsed, size))
+    conn.close()
+
+
+def run(fn, *args) -> tuple[int, float, int]:
+    context = get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(fn, args, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+with tempfile.TemporaryDirectory() as directory:
+    print(f"{'source':>16} {'operation':>22} {'pipeline':>16} {'peak KB':>10} {'ms':>9} {'output KB':>10}")
+    for frames, size in SOURCES:
+        path = os.path.join(directory, f"{frames}-{size[0]}x{size[1]}.gif")
+        make_gif(path, frames, size)
+        source = f"{frames}x{size[0]}x{size[1]}"
+        runs = [
+            ("re-encode GIF", "legacy", legacy_encode, (path, "")),
+            ("re-encode GIF", "frame by frame", new_encode, (path, "")),
+            (f"resize to {TARGET_WIDTH}w GIF", "legacy 1 frame", legacy_encode, (path, TARGET_WIDTH)),
+            (f"resize to {TARGET_WIDTH}w GIF", "legacy all", legacy_resize_all, (path, TARGET_WIDTH)),
+            (f"resize to {TARGET_WIDTH}w GIF", "frame by frame", new_encode, (path, TARGET_WIDTH)),
+            (f"resize to {TARGET_WIDTH}w WebP", "frame by frame", new_encode, (path, TARGET_WIDTH, "WEBP")),
+        ]
+        for operation, pipeline, fn, args in runs:
+            peak, elapsed, output = run(fn, *args)
+            print(f"{source:>16} {operation:>22} {pipeline:>16} {peak:>10} {elapsed * 1000:>9.0f} {output // 1024:>10}")
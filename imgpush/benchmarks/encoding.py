@@ -0,0 +1,100 @@
+"""
+Measures the bytes and encode time of originals and 320px wide variants of a
+synthetic photo and flat graphic, with the previous Pillow defaults, with the
+encoding profiles of originals and variants and with ADAPTIVE_ENCODING.
+
+Options are taken from the settings, so profiles can be compared with e.g.
+
+    VARIANT_ENCODE_OPTIONS='{"JPEG": {"quality": 70, "optimize": True}}' python imgpush/benchmarks/encoding.py
+"""
+import os
+import sys
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+import imgpush.settings as settings
+from imgpush.lib.convert_format import convert_format_type
+from imgpush.lib.encode_options import prepare
+from imgpush.lib.resize_image import resize_image
+
+SIZE = (1920, 1080)
+VARIANT_WIDTH = 320
+FORMATS = ["JPEG", "PNG", "WEBP"]
+ROUNDS = 3
+
+
+def make_photo() -> Image.Image:
+    # smooth gradients with sensor-like noise, so every pixel has its own color
+    gradient = Image.linear_gradient("L").resize(SIZE)
+    noise = Image.effect_noise(SIZE, 40)
+    photo = Image.merge("RGB", (gradient, noise.filter(ImageFilter.GaussianBlur(3)), gradient.rotate(90)))
+    draw = ImageDraw.Draw(photo)
+    for i in range(12):
+        draw.ellipse((i * 150, 200 + i * 40, i * 150 + 300, 500 + i * 40), fill=(40 + i * 15, 120, 200 - i * 10))
+    return photo.filter(ImageFilter.GaussianBlur(2))
+
+
+def make_graphic() -> Image.Image:
+    # a diagram: flat colors, sharp edges and text
+    graphic = Image.new("RGB", SIZE, "white")
+    draw = ImageDraw.Draw(graphic)
+    for i in range(10):
+        draw.rectangle((100 + i * 170, 100, 220 + i * 170, 900 - i * 60), fill=(30 * i, 90, 255 - 25 * i))
+        draw.text((100 + i * 170, 950), f"series {i}", fill="black")
+    draw.line((50, 1000, 1870, 1000), fill="black", width=4)
+    return graphic
+
+
+def legacy_image(img: Image.Image, file_format: str) -> Image.Image:
+    # convert_image made every PNG RGBA
+    return img.convert("RGBA") if file_format == "PNG" else img
+
+
+def encode(img: Image.Image, file_format: str, options: dict) -> tuple[int, float]:
+    elapsed = float("inf")
+    for _ in range(ROUNDS):
+        buffer = BytesIO()
+        start = time.perf_counter()
+        img.save(buffer, format=file_format, **options)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return len(buffer.getvalue()), elapsed
+
+
+def profiled(img: Image.Image, file_format: str, variant: bool, adaptive: bool) -> tuple[int, float]:
+    settings.ADAPTIVE_ENCODING = adaptive
+    start = time.perf_counter()
+    prepared, options = prepare(img, file_format, variant)
+    preparing = time.perf_counter() - start
+    size, elapsed = encode(prepared, file_format, options)
+    return size, elapsed + preparing
+
+
+images = {"photo": make_photo(), "graphic": make_graphic()}
+print(f"{'image':>8} {'format':>6} {'target':>8} {'encoder':>10} {'KB':>8} {'saved':>7} {'ms':>8}")
+totals = {}
+for name, img in images.items():
+    for target in ("original", "variant"):
+        variant = target == "variant"
+        source = resize_image(img, VARIANT_WIDTH, "") if variant else img
+        for file_format in FORMATS:
+            file_format = convert_format_type(file_format)
+            baseline, baseline_time = encode(legacy_image(source, file_format), file_format, {})
+            runs = [("defaults", baseline, baseline_time),
+                    ("profile", *profiled(source, file_format, variant, False)),
+                    ("adaptive", *profiled(source, file_format, variant, True))]
+            for encoder, size, elapsed in runs:
+                saved = 1 - size / baseline
+                totals.setdefault(encoder, [0, 0.0])
+                totals[encoder][0] += size
+                totals[encoder][1] += elapsed
+                print(f"{name:>8} {file_format:>6} {target:>8} {encoder:>10} {size / 1024:>8.1f} {saved:>7.1%} "
+                      f"{elapsed * 1000:>8.1f}")
+
+print()
+for encoder, (size, elapsed) in totals.items():
+    print(f"{'total':>8} {encoder:>10} {size / 1024:>8.1f} KB {1 - size / totals['defaults'][0]:>7.1%} saved "
+          f"{elapsed * 1000:>8.1f} ms")
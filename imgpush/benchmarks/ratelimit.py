@@ -0,0 +1,71 @@
+"""
+Compares the rate limit storages: the hits per second of one process, the hits
+per second of several processes sharing one limit, and how many hits those
+processes let through a limit of LIMIT, which is exact only if the storage is
+shared between them.
+
+    REDIS_URL=redis://localhost:6379 python imgpush/benchmarks/ratelimit.py
+
+Redis is skipped when REDIS_URL is not set.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+from limits import RateLimitItemPerMinute
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+import imgpush.lib.mmap_storage  # noqa: F401, registers the mmap scheme
+
+HITS = 20000
+PROCESSES = 4
+LIMIT = 100
+
+
+def hammer(uri: str, key: str, hits: int, limit: int, results):
+    limiter = FixedWindowRateLimiter(storage_from_string(uri))
+    item = RateLimitItemPerMinute(limit)
+    start = time.perf_counter()
+    allowed = sum(limiter.hit(item, key) for _ in range(hits))
+    results.put((allowed, time.perf_counter() - start))
+
+
+def run_processes(uri: str, key: str, hits: int, limit: int) -> tuple[int, float]:
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=hammer, args=(uri, key, hits, limit, results)) for _ in range(PROCESSES)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return sum(allowed for allowed, _ in outcomes), time.perf_counter() - start
+
+
+with tempfile.TemporaryDirectory() as directory:
+    backends = {"memory": "memory://", "mmap": f"mmap://{directory}/ratelimit"}
+    if os.getenv("REDIS_URL"):
+        backends["redis"] = os.getenv("REDIS_URL")
+
+    print(f"{'storage':>8} {'hits/s 1 process':>17} {f'hits/s {PROCESSES} processes':>18} "
+          f"{f'allowed of {LIMIT}':>15}")
+    for name, uri in backends.items():
+        storage = storage_from_string(uri)
+        storage.reset()
+        limiter = FixedWindowRateLimiter(storage)
+        item = RateLimitItemPerMinute(HITS * PROCESSES)
+        start = time.perf_counter()
+        for _ in range(HITS):
+            limiter.hit(item, "single")
+        single = HITS / (time.perf_counter() - start)
+
+        _allowed, elapsed = run_processes(uri, "shared", HITS, HITS * PROCESSES)
+        shared = HITS * PROCESSES / elapsed
+        allowed, _elapsed = run_processes(uri, "limited", LIMIT, LIMIT)
+        print(f"{name:>8} {single:>17.0f} {shared:>18.0f} {allowed:>15}")
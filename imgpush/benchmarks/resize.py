@@ -0,0 +1,76 @@
+"""
+Checks the output of resize_image against the previous resize pipeline
+and measures the speedup per source size.
+
+    python imgpush/benchmarks/resize.py
+"""
+import os
+import sys
+import time
+from io import BytesIO
+import timeout_decorator
+from PIL import Image, ImageDraw
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+import imgpush.settings as settings
+from imgpush.lib.resize_image import resize_image
+
+SOURCE_SIZES = [(640, 480), (1920, 1080), (4000, 3000), (6000, 4000)]
+TARGET_SIZES = [(64, 64), (320, ""), ("", 240), (1000, 1000)]
+ROUNDS = 5
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, max(width // 40, 1)):
+        draw.line((i, 0, width - i, height), fill=(i % 256, 80, 160), width=3)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def legacy_resize(img: Image.Image, width, height) -> Image.Image:
+    """The previous pipeline: full decode, then a plain resize (its crop was discarded)."""
+    current_aspect_ratio = img.width / img.height
+    if not width:
+        width = int(current_aspect_ratio * height)
+    if not height:
+        height = int(width / current_aspect_ratio)
+
+    @timeout_decorator.timeout(settings.RESIZE_TIMEOUT, use_signals=False)
+    def resize(img, width, height):
+        return img.resize((width, height))
+
+    return resize(img, width, height)
+
+
+def timed(fn, data: bytes, width, height) -> tuple[float, Image.Image]:
+    best = float("inf")
+    result = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        with Image.open(BytesIO(data)) as img:
+            result = fn(img, width, height)
+            result.load()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+print(f"{'source':>10} {'target':>10} {'legacy ms':>10} {'new ms':>10} {'speedup':>8}")
+for source_width, source_height in SOURCE_SIZES:
+    data = make_jpeg(source_width, source_height)
+    for width, height in TARGET_SIZES:
+        legacy_time, legacy = timed(legacy_resize, data, width, height)
+        new_time, new = timed(resize_image, data, width, height)
+
+        if new.size != legacy.size:
+            raise ValueError(f"Dimensions differ for {source_width}x{source_height} -> {width}x{height}: "
+                             f"{new.size} != {legacy.size}")
+
+        print(f"{source_width}x{source_height:<5} {f'{width}x{height}':>10} "
+              f"{legacy_time * 1000:>10.1f} {new_time * 1000:>10.1f} {legacy_time / new_time:>7.1f}x")
+
+print("Dimensions of resized images are as expected OK")
@@ -0,0 +1,145 @@
+"""
+Load test of the serving modes: the werkzeug development server, gunicorn with
+threaded workers and gunicorn with gevent workers. Each one serves a fresh
+storage directory on a local port, CLIENTS keep-alive clients fetch an original
+image for DURATION seconds and the requests per second and p50/p99 latencies
+are reported, then again while SLOW_CLIENTS connections send their request
+headers one byte at a time.
+
+    python imgpush/benchmarks/serve.py
+"""
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+
+PORT = 5099
+WORKERS = 2
+THREADS = 8
+CLIENTS = 16
+SLOW_CLIENTS = 64
+DURATION = 5
+
+MODES = {
+    "werkzeug": ([sys.executable, "imgpush/app.py"], {}),
+    "gthread": ([sys.executable, "imgpush/wsgi.py"], {"SERVER_WORKER_CLASS": "gthread"}),
+    "gevent": ([sys.executable, "imgpush/wsgi.py"], {"SERVER_WORKER_CLASS": "gevent"}),
+}
+
+
+def start(command: list, env: dict) -> subprocess.Popen:
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            conn.request("GET", "/liveness")
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception(f"{command} did not start")
+
+
+def upload() -> str:
+    buffer = BytesIO()
+    Image.effect_noise((800, 600), 64).convert("RGB").save(buffer, format="JPEG", quality=85)
+    body = (b"--boundary\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.jpg\"\r\n"
+            b"Content-Type: image/jpeg\r\n\r\n" + buffer.getvalue() + b"\r\n--boundary--\r\n")
+    conn = http.client.HTTPConnection("127.0.0.1", PORT)
+    conn.request("POST", "/", body, {"Content-Type": "multipart/form-data; boundary=boundary"})
+    return json.loads(conn.getresponse().read())["filename"]
+
+
+def client(path: str, deadline: float, latencies: list, errors: list):
+    conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise Exception(response.status)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(1)
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=10)
+
+
+def slow_client(stop: threading.Event):
+    request = f"GET /liveness HTTP/1.1\r\nHost: 127.0.0.1\r\nX-Padding: {'a' * 200}\r\n\r\n".encode()
+    try:
+        with socket.create_connection(("127.0.0.1", PORT), timeout=10) as sock:
+            for byte in request:
+                if stop.wait(0.1):
+                    return
+                sock.send(bytes([byte]))
+    except OSError:
+        pass
+
+
+def load(path: str, slow: int) -> dict:
+    stop = threading.Event()
+    slow_threads = [threading.Thread(target=slow_client, args=(stop,)) for _ in range(slow)]
+    for thread in slow_threads:
+        thread.start()
+    time.sleep(0.5 if slow else 0)
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + DURATION
+    threads = [threading.Thread(target=client, args=(path, deadline, latencies, errors)) for _ in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    for thread in slow_threads:
+        thread.join()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [float("nan")] * 99
+    return {
+        "requests_per_second": len(latencies) / DURATION,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "errors": len(errors),
+    }
+
+
+results = {}
+for mode, (command, mode_env) in MODES.items():
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("images", "cache", "variants"):
+            os.mkdir(os.path.join(directory, name))
+        env = dict(os.environ, **mode_env,
+                   PORT=str(PORT),
+                   SERVER_WORKERS=str(WORKERS),
+                   SERVER_THREADS=str(THREADS),
+                   USE_MONGO="False",
+                   MAX_UPLOADS_PER_MINUTE="1000",
+                   RATE_LIMIT_STORAGE_URI=f"mmap://{directory}/ratelimit",
+                   IMAGES_DIR=os.path.join(directory, "images") + "/",
+                   CACHE_DIR=os.path.join(directory, "cache") + "/",
+                   VARIANTS_DIR=os.path.join(directory, "variants") + "/")
+        server = start(command, env)
+        try:
+            path = f"/{upload()}"
+            results[mode] = {"fast": load(path, 0), "with_slow_clients": load(path, SLOW_CLIENTS)}
+        finally:
+            server.terminate()
+            server.wait()
+
+print(f"{'mode':>9} {'scenario':>18} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+for mode, scenarios in results.items():
+    for scenario, result in scenarios.items():
+        print(f"{mode:>9} {scenario:>18} {result['requests_per_second']:>8.0f} {result['p50_ms']:>8.2f} "
+              f"{result['p99_ms']:>8.2f} {result['errors']:>7}")
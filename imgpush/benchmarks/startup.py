@@ -0,0 +1,72 @@
+"""
+Measures how fast a worker starts: the import time of imgpush.app, the time
+to its first request and the mongodb clients created by the import, each in
+a fresh interpreter, with the filesystem and the mongodb storage.
+
+    MONGO_URI=mongodb://localhost python imgpush/benchmarks/startup.py
+
+Without MONGO_URI an unreachable server is used, which shows whether startup
+waits for mongodb.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROUNDS = 5
+UNREACHABLE_MONGO_URI = "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=2000"
+
+CHILD = r"""
+import json, os, sys, time
+sys.path.append(os.getcwd())
+import pymongo
+
+created = []
+init = pymongo.MongoClient.__init__
+def counting_init(self, *args, **kwargs):
+    created.append(1)
+    init(self, *args, **kwargs)
+pymongo.MongoClient.__init__ = counting_init
+
+start = time.perf_counter()
+import imgpush.app as module
+imported = time.perf_counter()
+clients = len(created)
+status = module.app.test_client().get("/liveness").status_code
+first_request = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_request": first_request - start,
+                  "clients": clients, "status": status}))
+os._exit(0)
+"""
+
+
+def run(use_mongo: bool, directory: str) -> dict:
+    env = dict(os.environ,
+               USE_MONGO=str(use_mongo),
+               MONGO_URI=os.getenv("MONGO_URI") or UNREACHABLE_MONGO_URI,
+               IMAGES_DIR=os.path.join(directory, "images") + "/",
+               CACHE_DIR=os.path.join(directory, "cache") + "/",
+               VARIANTS_DIR=os.path.join(directory, "variants") + "/")
+    output = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+results = {}
+with tempfile.TemporaryDirectory() as directory:
+    for name in ("images", "cache", "variants"):
+        os.mkdir(os.path.join(directory, name))
+    for use_mongo in (False, True):
+        runs = [run(use_mongo, directory) for _ in range(ROUNDS)]
+        results["mongo" if use_mongo else "file"] = {
+            "import_ms": statistics.median(r["import"] for r in runs) * 1000,
+            "first_request_ms": statistics.median(r["first_request"] for r in runs) * 1000,
+            "clients_at_import": max(r["clients"] for r in runs),
+            "status": runs[-1]["status"],
+        }
+
+print(f"{'storage':>8} {'import ms':>10} {'first request ms':>17} {'clients at import':>18} {'status':>7}")
+for storage, result in results.items():
+    print(f"{storage:>8} {result['import_ms']:>10.1f} {result['first_request_ms']:>17.1f} "
+          f"{result['clients_at_import']:>18} {result['status']:>7}")
@@ -0,0 +1,371 @@
+"""
+Offline benchmark suite: needs neither network access nor a running server.
+Synthetic images of several sizes and formats are uploaded, then served as
+originals, resized for the first time (cold) and resized again (warm, from the
+resized image cache). Every scenario reports its throughput and p50/p99
+latencies, for the filesystem and the GridFS storage, through the flask test
+client in the benchmark process and through a local server on PORT.
+
+    python imgpush/benchmarks/suite.py --output results.json
+    python imgpush/benchmarks/suite.py --compare results.json
+
+GridFS uses MONGO_URI when it is set, it should point at a throwaway mongod as
+the images are stored in its imgpush database. Otherwise it uses mongomock, an
+in-process stand-in, which measures imgpush rather than mongodb; the server
+then runs a single worker, since every worker would have its own mock
+database. The server is gunicorn (imgpush/wsgi.py), or the development server
+when gunicorn is not installed. Each run uses fresh storage directories and
+its own interpreter, as the settings are read at import.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from PIL import Image, ImageDraw
+import PIL
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+PORT = 5098
+BACKENDS = ("fs", "gridfs")
+MODES = ("client", "server")
+# (name, format, width, height)
+IMAGES = [
+    ("jpeg-640x480", "JPEG", 640, 480),
+    ("jpeg-1920x1080", "JPEG", 1920, 1080),
+    ("png-800x600", "PNG", 800, 600),
+    ("webp-1280x720", "WEBP", 1280, 720),
+]
+WARM_WIDTH = 320
+BOUNDARY = "imgpush-benchmark"
+
+
+def make_image(file_format: str, width: int, height: int) -> bytes:
+    """Noise for texture, which JPEG and WebP encode like a photo, under shapes that PNG compresses."""
+    img = Image.effect_noise((width, height), 40).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        box = (i * width // 14, i * height // 20, i * width // 14 + width // 4, i * height // 20 + height // 3)
+        draw.rectangle(box, fill=(i * 20, 120, 255 - i * 20))
+    buffer = BytesIO()
+    img.save(buffer, format=file_format, quality=85)
+    return buffer.getvalue()
+
+
+def multipart(data: bytes, filename: str) -> bytes:
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+class ClientTransport:
+    """Sends requests through the flask test client, one per thread."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, body: bytes | None = None) -> tuple[int, bytes]:
+        if body is None:
+            response = self.client.open(path, method=method)
+        else:
+            response = self.client.open(path, method=method, data=body,
+                                        content_type=f"multipart/form-data; boundary={BOUNDARY}")
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Sends requests to the local server over a keep-alive connection, one per thread."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def request(self, method: str, path: str, body: bytes | None = None) -> tuple[int, bytes]:
+        headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"} if body is not None else {}
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            raise
+
+    def close(self):
+        self.conn.close()
+
+
+def measure(new_transport, requests: list[tuple[str, str, bytes | None]], concurrency: int) -> tuple[dict, list]:
+    """
+    The measure function sends requests from concurrency threads and times them.
+
+    :param new_transport: Callable: Creates the transport of a thread
+    :param requests: list: The (method, path, body) of every request
+    :param concurrency: int: The number of threads sending requests
+    :return: The statistics of the run, and the (status, body) of every request in order
+    """
+    jobs: queue.Queue = queue.Queue()
+    for job in enumerate(requests):
+        jobs.put(job)
+    responses: list = [None] * len(requests)
+    latencies: list[float] = []
+
+    def worker():
+        transport = new_transport()
+        try:
+            while True:
+                try:
+                    index, (method, path, body) = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                try:
+                    responses[index] = transport.request(method, path, body)
+                except Exception as e:
+                    responses[index] = (0, repr(e).encode())
+                latencies.append(time.perf_counter() - start)
+        finally:
+            transport.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(requests),
+        "errors": sum(1 for status, _body in responses if status != 200),
+        "throughput_rps": len(requests) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }, responses
+
+
+def run_scenarios(new_transport, count: int, concurrency: int) -> list[dict]:
+    """
+    The run_scenarios function runs every scenario for every synthetic image.
+
+    :param new_transport: Callable: Creates the transport of a thread
+    :param count: int: The number of requests per scenario and image
+    :param concurrency: int: The number of threads sending requests
+    :return: The results, one per image and scenario
+    """
+    results = []
+    for name, file_format, width, height in IMAGES:
+        body = multipart(make_image(file_format, width, height), f"{name}.{file_format.lower()}")
+        stats, responses = measure(new_transport, [("POST", "/", body)] * count, concurrency)
+        results.append(dict(image=name, scenario="upload", **stats))
+        filenames = [json.loads(response)["filename"] for status, response in responses if status == 200]
+        if not filenames:
+            raise Exception(f"Uploading {name} failed: {responses[0]}")
+
+        paths = [f"/{filenames[i % len(filenames)]}" for i in range(count)]
+        stats, _responses = measure(new_transport, [("GET", path, None) for path in paths], concurrency)
+        results.append(dict(image=name, scenario="original", **stats))
+
+        # every request asks for a size of an image that was never resized before
+        cold = [("GET", f"{path}?w={16 + i}", None) for i, path in enumerate(paths)]
+        stats, _responses = measure(new_transport, cold, concurrency)
+        results.append(dict(image=name, scenario="cold_resize", **stats))
+
+        warm = [("GET", f"/{filename}?w={WARM_WIDTH}", None) for filename in filenames]
+        measure(new_transport, warm, concurrency)
+        stats, _responses = measure(new_transport, [("GET", f"{path}?w={WARM_WIDTH}", None) for path in paths],
+                                    concurrency)
+        results.append(dict(image=name, scenario="warm_resize", **stats))
+    return results
+
+
+def use_mongomock():
+    # must run before imgpush imports pymongo
+    import mongomock
+    import mongomock.gridfs
+    import pymongo
+    mongomock.gridfs.enable_gridfs_integration()
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def has_gunicorn() -> bool:
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def has_mongomock() -> bool:
+    try:
+        import mongomock  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def child_main(args):
+    """Runs in the interpreter of one run, configured by the environment."""
+    if os.environ["USE_MONGO"] == "True" and not os.environ.get("MONGO_URI"):
+        use_mongomock()
+    if args.serve:
+        runpy.run_path("imgpush/wsgi.py" if has_gunicorn() else "imgpush/app.py", run_name="__main__")
+        return
+    from imgpush.app import app
+    results = run_scenarios(lambda: ClientTransport(app), args.requests, args.concurrency)
+    print(json.dumps(results))
+    sys.stdout.flush()
+    # the resize workers would outlive os._exit and keep stdout open, the scheduler would keep the interpreter alive
+    for child in multiprocessing.active_children():
+        child.kill()
+    os._exit(0)
+
+
+def run_env(directory: str, backend: str, workers: int) -> dict:
+    for name in ("images", "cache", "variants"):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+    return dict(os.environ,
+                USE_MONGO=str(backend == "gridfs"),
+                MONGO_URI=os.getenv("MONGO_URI", ""),
+                IMAGES_DIR=os.path.join(directory, "images") + "/",
+                CACHE_DIR=os.path.join(directory, "cache") + "/",
+                VARIANTS_DIR=os.path.join(directory, "variants") + "/",
+                RATE_LIMIT_STORAGE_URI=f"mmap://{directory}/ratelimit",
+                METRICS_FILE=os.path.join(directory, "metrics"),
+                MAX_UPLOADS_PER_DAY="100000000",
+                MAX_UPLOADS_PER_HOUR="100000000",
+                MAX_UPLOADS_PER_MINUTE="100000000",
+                PORT=str(PORT),
+                SERVER_WORKERS=str(workers))
+
+
+def child_command(args, *flags) -> list[str]:
+    return [sys.executable, "imgpush/benchmarks/suite.py", "--child", *flags,
+            "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+
+
+def run_client(args, env: dict) -> list[dict]:
+    output = subprocess.run(child_command(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run_server(args, env: dict) -> list[dict]:
+    server = subprocess.Popen(child_command(args, "--serve"), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+                conn.request("GET", "/liveness")
+                if conn.getresponse().status == 200:
+                    break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise Exception("The server did not start")
+        return run_scenarios(lambda: HTTPTransport(PORT), args.requests, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def key(result: dict) -> tuple:
+    return result["backend"], result["mode"], result["image"], result["scenario"]
+
+
+def print_results(results: list[dict], baseline: list[dict] | None):
+    previous = {key(result): result for result in baseline or []}
+    header = (f"{'backend':>7} {'mode':>6} {'image':>15} {'scenario':>12} "
+              f"{'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    print(header + (f" {'req/s change':>13} {'p99 change':>11}" if baseline is not None else ""))
+    for result in results:
+        line = (f"{result['backend']:>7} {result['mode']:>6} {result['image']:>15} {result['scenario']:>12} "
+                f"{result['throughput_rps']:>8.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                f"{result['errors']:>6}")
+        before = previous.get(key(result))
+        if before:
+            line += (f" {result['throughput_rps'] / before['throughput_rps'] - 1:>+13.1%}"
+                     f" {result['p99_ms'] / before['p99_ms'] - 1:>+11.1%}")
+        print(line)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    mongomock_used = "gridfs" in args.backends and not os.getenv("MONGO_URI")
+    if mongomock_used and not has_mongomock():
+        print("Skipping gridfs: set MONGO_URI or install mongomock", file=sys.stderr)
+        args.backends = [backend for backend in args.backends if backend != "gridfs"]
+
+    results = []
+    for backend in args.backends:
+        for mode in args.modes:
+            # every worker of the server would have its own mongomock database
+            workers = 1 if backend == "gridfs" and mongomock_used else args.server_workers
+            with tempfile.TemporaryDirectory() as directory:
+                env = run_env(directory, backend, workers)
+                runs = run_client(args, env) if mode == "client" else run_server(args, env)
+            results += [dict(backend=backend, mode=mode, **result) for result in runs]
+
+    report = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "cpus": os.cpu_count(),
+        "server": "gunicorn" if has_gunicorn() else "werkzeug",
+        "server_workers": args.server_workers,
+        "mongodb": "MONGO_URI" if os.getenv("MONGO_URI") else "mongomock",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+parser = argparse.ArgumentParser(description="Offline benchmark of uploads, originals and resizes")
+parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+parser.add_argument("--requests", type=int, default=40, help="requests per scenario and image")
+parser.add_argument("--concurrency", type=int, default=4, help="clients sending requests at once")
+parser.add_argument("--server-workers", type=int, default=2)
+parser.add_argument("--output", help="write the results as json to this file")
+parser.add_argument("--compare", help="json results of an earlier run to compare with")
+parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+
+if __name__ == "__main__":
+    arguments = parser.parse_args()
+    if arguments.child:
+        child_main(arguments)
+    else:
+        main(arguments)
@@ -0,0 +1,124 @@
+"""
+Measures the peak memory and the bytes written to disk per upload for the
+previous upload pipeline (temporary file in /tmp, sniff, decode, convert,
+encode to bytes, write) and the spooled single decode pipeline.
+
+Every upload runs in a forked process, so the peak RSS of one run does not
+hide the next. Bytes written are read from /proc/self/io and include the
+stored image itself, which is the same for both pipelines.
+
+    python imgpush/benchmarks/upload.py
+"""
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+from multiprocessing import get_context
+import filetype
+from PIL import Image, ImageDraw
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+# must be set before settings is imported
+images_dir = tempfile.mkdtemp(prefix="imgpush-benchmark-")
+os.environ["IMAGES_DIR"] = images_dir + "/"
+os.environ["PREGENERATE_SIZES"] = "[]"
+
+from imgpush.lib.convert_format import convert_format_type, convert_image
+from imgpush.lib.filename import get_random_filename, get_shard_path
+from imgpush.lib.remove_metadata import remove_metadata
+from imgpush.lib.upload import spooled_file, store_upload
+from imgpush.lib.utils import atomic_write, pil_to_binary
+
+SOURCE_SIZES = [(640, 480), (1920, 1080), (4000, 3000)]
+FORMATS = ["JPEG", "PNG"]
+# werkzeug kept uploads up to this size in memory and wrote larger ones to a temporary file
+WERKZEUG_MEMORY_LIMIT = 500 * 1024
+
+
+def make_image(width: int, height: int, file_format: str) -> bytes:
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, max(width // 40, 1)):
+        draw.line((i, 0, width - i, height), fill=(i % 256, 80, 160), width=3)
+    buffer = BytesIO()
+    img.save(buffer, format=file_format)
+    return buffer.getvalue()
+
+
+def legacy_upload(data: bytes):
+    """The previous pipeline of upload_image in filesystem mode."""
+    stream = tempfile.TemporaryFile() if len(data) > WERKZEUG_MEMORY_LIMIT else BytesIO()
+    stream.write(data)
+    stream.seek(0)
+
+    tmp_filepath = os.path.join("/tmp/", get_random_filename())
+    with open(tmp_filepath, "wb") as f:
+        shutil.copyfileobj(stream, f)
+    stream.close()
+    try:
+        output_type = filetype.guess_extension(tmp_filepath)
+        with Image.open(tmp_filepath) as img:
+            img = remove_metadata(img)
+            file_format = convert_format_type(output_type)
+            with convert_image(img, file_format) as converted:
+                output_binary = pil_to_binary(converted, file_format)
+            output_filename = os.path.basename(tmp_filepath) + f".{output_type}"
+            atomic_write(get_shard_path(images_dir, output_filename), output_binary, exclusive=True)
+    finally:
+        os.remove(tmp_filepath)
+
+
+def spooled_upload(data: bytes):
+    """The current pipeline of upload_image in filesystem mode."""
+    stream = spooled_file()
+    stream.write(data)
+    stream.seek(0)
+    try:
+        store_upload(stream, get_random_filename())
+    finally:
+        stream.close()
+
+
+def written_bytes() -> int:
+    with open("/proc/self/io") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("wchar"))
+
+
+def measure(fn, data: bytes, conn):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    written = written_bytes()
+    start = time.perf_counter()
+    fn(data)
+    elapsed = time.perf_counter() - start
+    conn.send((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss, written_bytes() - written, elapsed))
+    conn.close()
+
+
+def run(fn, data: bytes) -> tuple[int, int, float]:
+    context = get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(fn, data, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+try:
+    print(f"{'source':>14} {'upload KB':>10} {'legacy peak KB':>15} {'new peak KB':>12} "
+          f"{'legacy written KB':>18} {'new written KB':>15} {'legacy ms':>10} {'new ms':>8}")
+    for file_format in FORMATS:
+        for width, height in SOURCE_SIZES:
+            data = make_image(width, height, file_format)
+            legacy_rss, legacy_written, legacy_time = run(legacy_upload, data)
+            new_rss, new_written, new_time = run(spooled_upload, data)
+            print(f"{file_format:>4} {f'{width}x{height}':>9} {len(data) // 1024:>10} {legacy_rss:>15} {new_rss:>12} "
+                  f"{legacy_written // 1024:>18} {new_written // 1024:>15} "
+                  f"{legacy_time * 1000:>10.1f} {new_time * 1000:>8.1f}")
+finally:
+    shutil.rmtree(images_dir)
@@ -0,0 +1,237 @@
+import struct
+from functools import reduce
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterator
+from PIL import Image, ImageChops
+import imgpush.settings as settings
+from imgpush.lib.convert_format import convert_format_type
+from imgpush.lib.encode_options import encode_options
+
+# output formats whose animations are encoded frame by frame
+ANIMATION_FORMATS = ("GIF", "WEBP")
+ALPHA_MODES = ("RGBA", "LA", "PA")
+
+GIF_GRAPHIC_CONTROL = 0xF9
+GIF_DISPOSE_NONE = 1
+GIF_DISPOSE_BACKGROUND = 2
+
+WEBP_FLAG_ALPHA = 0x10
+WEBP_FLAG_ANIMATION = 0x02
+# ANMF flags: the frame replaces the pixels under it instead of being alpha blended
+WEBP_NO_BLEND = 0x02
+WEBP_FRAME_CHUNKS = (b"ALPH", b"VP8 ", b"VP8L")
+
+
+def is_animated(img: Image.Image) -> bool:
+    return getattr(img, "n_frames", 1) > 1
+
+
+def check_animation(img: Image.Image, size: tuple[int, int] | None = None):
+    """
+    The check_animation function rejects animations whose frames hold more than
+    MAX_ANIMATION_PIXELS pixels in total, without decoding them.
+
+    :param img: Image.Image: The opened animation
+    :param size: tuple[int, int] | None: The size of the output frames, defaults to the size of the animation
+    """
+    width, height = size or img.size
+    pixels = getattr(img, "n_frames", 1) * width * height
+    if pixels > settings.MAX_ANIMATION_PIXELS:
+        raise Image.DecompressionBombError(f"Animation has {pixels} pixels in its frames, "
+                                           f"more than the limit of {settings.MAX_ANIMATION_PIXELS}")
+
+
+def iter_frames(img: Image.Image) -> Iterator[tuple[Image.Image, int]]:
+    """
+    Yields every frame of an animation as it is displayed, with its duration in
+    milliseconds. Frames are composited by the decoder, so only the current one
+    is held in memory.
+    """
+    img.seek(0)
+    mode = "RGBA" if img.mode in ALPHA_MODES or "transparency" in img.info else "RGB"
+    for index in range(img.n_frames):
+        img.seek(index)
+        yield img.convert(mode), int(img.info.get("duration") or 0)
+
+
+def save_animation(img: Image.Image, fp: BinaryIO, file_format: str,
+                   transform: Callable[[Image.Image], Image.Image] | None = None, variant: bool = False):
+    """
+    The save_animation function encodes an animated GIF or WebP frame by frame.
+    Every frame is decoded, transformed and encoded before the next one is
+    decoded, so only the current and the previous frame are held in memory
+    however long the animation is. Frame durations and the loop count are kept.
+
+    :param img: Image.Image: The opened animation
+    :param fp: BinaryIO: Where to write the encoded animation
+    :param file_format: str: "GIF" or "WEBP"
+    :param transform: Callable: Applied to every frame, e.g. to resize it
+    :param variant: bool: Whether frames are encoded with the profile of variants instead of originals
+    """
+    check_animation(img)
+    loop = img.info.get("loop")
+    writer_class = GifWriter if convert_format_type(file_format) == "GIF" else WebPWriter
+    writer = None
+    previous = None
+    for frame, duration in iter_frames(img):
+        if transform:
+            frame = transform(frame)
+        if writer is None:
+            check_animation(img, frame.size)
+            writer = writer_class(fp, frame.size, loop, frame.mode == "RGBA", encode_options(file_format, variant))
+        writer.add(frame, duration, previous)
+        previous = frame
+    writer.close()
+
+
+def changed_box(previous: Image.Image | None, frame: Image.Image) -> tuple[int, int, int, int]:
+    """
+    Returns the box of the pixels that differ between two frames.
+    """
+    if previous is None:
+        return 0, 0, frame.width, frame.height
+    difference = ImageChops.difference(previous, frame)
+    # getbbox only looks at the alpha band of RGBA images
+    return reduce(ImageChops.lighter, difference.split()).getbbox() or (0, 0, 1, 1)
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def parse_gif_frame(data: bytes) -> tuple[bytes, int, int | None, bytes]:
+    """
+    The parse_gif_frame function splits a single frame GIF into the parts that
+    make up a frame of an animation.
+
+    :param data: bytes: The GIF
+    :return: The color table, the flags of its image descriptor, the transparent color index and the image data
+    """
+    if data[:3] != b"GIF":
+        raise ValueError("Missing GIF header")
+    flags = data[10]
+    pos = 13
+    palette = b""
+    if flags & 0x80:
+        palette = data[pos:pos + (3 << ((flags & 7) + 1))]
+        pos += len(palette)
+    palette_flags = flags & 7
+
+    transparency = None
+    while data[pos] == 0x21:
+        label = data[pos + 1]
+        pos += 2
+        if label == GIF_GRAPHIC_CONTROL and data[pos + 1] & 1:
+            transparency = data[pos + 4]
+        pos = _skip_sub_blocks(data, pos)
+    if data[pos] != 0x2C:
+        raise ValueError("Missing GIF image descriptor")
+
+    descriptor_flags = data[pos + 9]
+    pos += 10
+    if descriptor_flags & 0x80:
+        palette = data[pos:pos + (3 << ((descriptor_flags & 7) + 1))]
+        pos += len(palette)
+        palette_flags = descriptor_flags & 7
+    if not palette:
+        raise ValueError("Missing GIF color table")
+
+    # the LZW minimum code size, then the data sub-blocks
+    start = pos
+    pos = _skip_sub_blocks(data, pos + 1)
+    return palette, (descriptor_flags & 0x40) | palette_flags, transparency, data[start:pos]
+
+
+class GifWriter:
+    """
+    Writes an animated GIF frame by frame. Every frame is encoded by Pillow as
+    a single frame GIF, whose color table becomes the local color table of the
+    frame, so each frame keeps its own palette. Opaque animations only store
+    the pixels that changed since the previous frame, frames of animations
+    with transparency are stored whole and cleared before the next one.
+    """
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int], loop: int | None, alpha: bool,
+                 options: dict | None = None):
+        self.fp = fp
+        self.options = options or {}
+        self.disposal = GIF_DISPOSE_BACKGROUND if alpha else GIF_DISPOSE_NONE
+        fp.write(b"GIF89a" + struct.pack("<HHBBB", *size, 0, 0, 0))
+        if loop is not None:
+            fp.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+
+    def add(self, frame: Image.Image, duration: int, previous: Image.Image | None):
+        box = (0, 0, *frame.size) if self.disposal == GIF_DISPOSE_BACKGROUND else changed_box(previous, frame)
+        buffer = BytesIO()
+        frame.crop(box).save(buffer, format="GIF", **self.options)
+        palette, flags, transparency, image_data = parse_gif_frame(buffer.getvalue())
+
+        control = (self.disposal << 2) | (transparency is not None)
+        self.fp.write(b"!\xf9\x04" + struct.pack("<BHB", control, min(round(duration / 10), 0xFFFF),
+                                                 transparency or 0) + b"\x00")
+        self.fp.write(struct.pack("<BHHHHB", 0x2C, box[0], box[1], box[2] - box[0], box[3] - box[1], 0x80 | flags))
+        self.fp.write(palette + image_data)
+
+    def close(self):
+        self.fp.write(b";")
+
+
+def webp_frame_chunks(data: bytes) -> bytes:
+    """
+    Returns the image data chunks of a single frame WebP, without its headers and metadata.
+    """
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        raise ValueError("Missing WebP header")
+    chunks = []
+    pos = 12
+    while pos + 8 <= len(data):
+        fourcc, length = struct.unpack("<4sI", data[pos:pos + 8])
+        end = pos + 8 + length + (length & 1)
+        if fourcc in WEBP_FRAME_CHUNKS:
+            chunks.append(data[pos:end])
+        pos = end
+    return b"".join(chunks)
+
+
+def _uint24(value: int) -> bytes:
+    return value.to_bytes(3, "little")
+
+
+class WebPWriter:
+    """
+    Writes an animated WebP frame by frame. Every frame is encoded by Pillow as
+    a single frame WebP and only the pixels that changed since the previous
+    frame are stored, replacing the pixels under them. The RIFF header needs the
+    total size, so the encoded frames are collected before being written.
+    """
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int], loop: int | None, alpha: bool,
+                 options: dict | None = None):
+        self.fp = fp
+        self.options = options or {}
+        self.size = size
+        # without a loop count a GIF is played once
+        self.loop = 1 if loop is None else loop
+        self.alpha = alpha
+        self.frames = BytesIO()
+
+    def add(self, frame: Image.Image, duration: int, previous: Image.Image | None):
+        left, top, right, bottom = changed_box(previous, frame)
+        # frame offsets are stored halved
+        left, top = left & ~1, top & ~1
+        buffer = BytesIO()
+        frame.crop((left, top, right, bottom)).save(buffer, format="WEBP", **self.options)
+        payload = (_uint24(left // 2) + _uint24(top // 2) + _uint24(right - left - 1) + _uint24(bottom - top - 1)
+                   + _uint24(min(duration, 0xFFFFFF)) + bytes([WEBP_NO_BLEND]) + webp_frame_chunks(buffer.getvalue()))
+        self.frames.write(b"ANMF" + struct.pack("<I", len(payload)) + payload + b"\x00" * (len(payload) & 1))
+
+    def close(self):
+        flags = WEBP_FLAG_ANIMATION | (WEBP_FLAG_ALPHA if self.alpha else 0)
+        header = bytes([flags, 0, 0, 0]) + _uint24(self.size[0] - 1) + _uint24(self.size[1] - 1)
+        # transparent background color, loop count
+        anim = struct.pack("<IH", 0, self.loop)
+        body = (b"WEBP" + b"VP8X" + struct.pack("<I", len(header)) + header
+                + b"ANIM" + struct.pack("<I", len(anim)) + anim + self.frames.getvalue())
+        self.fp.write(b"RIFF" + struct.pack("<I", len(body)) + body)
@@ -1,34 +1,203 @@
 import logging
 import os
+import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 import imgpush.settings as settings
-from imgpush.lib.db import cachefs
+from imgpush.lib import metrics
+from imgpush.lib.db import db, cachefs
+from imgpush.lib.filename import find_path, iter_files
+from imgpush.lib.leader import is_leader
+
+# accesses of the same cached file are recorded at most once per interval
+TOUCH_INTERVAL = 60
+# how many files are evicted per query
+EVICT_BATCH = 100
+
+
+class CacheIndex:
+    """
+    A SQLite index of the files in CACHE_DIR with their size and last access
+    time, shared by all worker processes, so that eviction never lists the directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # connections can be shared neither between threads nor across a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, filename: str, size: int):
+        self._conn().execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (filename, size, time.time()))
+
+    def touch(self, filename: str):
+        self._conn().execute("UPDATE files SET accessed = ? WHERE filename = ?", (time.time(), filename))
+
+    def remove(self, filename: str):
+        self._conn().execute("DELETE FROM files WHERE filename = ?", (filename,))
+
+    def usage(self) -> tuple[int, int]:
+        """
+        Returns the number of indexed files and their total size in bytes.
+        """
+        count, size = self._conn().execute("SELECT COUNT(*), TOTAL(size) FROM files").fetchone()
+        return count, int(size)
+
+    def least_recently_used(self, limit: int, accessed_before: float | None = None) -> list[tuple[str, int]]:
+        query, args = "SELECT filename, size FROM files", ()
+        if accessed_before is not None:
+            query, args = query + " WHERE accessed < ?", (accessed_before,)
+        return self._conn().execute(query + " ORDER BY accessed LIMIT ?", (*args, limit)).fetchall()
+
+    def needs_rebuild(self) -> bool:
+        return self._conn().execute("SELECT 1 FROM meta WHERE key = 'rebuilt'").fetchone() is None
+
+    def rebuild(self):
+        """
+        Indexes the files already in CACHE_DIR, using their mtime as access time.
+        Only needed once, when the index is created for an existing cache.
+        """
+        conn = self._conn()
+        for filename, path in iter_files(settings.CACHE_DIR):
+            stat = os.stat(path)
+            conn.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?)", (filename, stat.st_size, stat.st_mtime))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('rebuilt', '1')")
+
+
+cache_index = CacheIndex(os.path.join(settings.CACHE_DIR, ".index.sqlite"))
+
+# filename -> time of the last recorded access in this process
+_touched: dict[str, float] = {}
+
+
+def record_cache_write(filename: str, size: int):
+    """
+    The record_cache_write function adds a newly written file in CACHE_DIR to the index.
+    GridFS cache files carry their own metadata.lastAccess instead.
+    """
+    if not settings.USE_MONGO:
+        cache_index.add(filename, size)
+
+
+def record_cache_access(filename: str):
+    """
+    The record_cache_access function marks a cached file as recently used,
+    at most once per TOUCH_INTERVAL per process.
+    """
+    now = time.time()
+    if now - _touched.get(filename, 0) < TOUCH_INTERVAL:
+        return
+    if len(_touched) > 100000:
+        _touched.clear()
+    _touched[filename] = now
+    try:
+        if settings.USE_MONGO:
+            db["cache.files"].update_one({"filename": filename}, {"$set": {"metadata.lastAccess": datetime.now()}})
+        else:
+            cache_index.touch(filename)
+    except Exception as e:
+        logging.warning(f"Failed to record access of cache {filename}: {e}")
+
 
 def autodel_cache():
+    # every worker schedules the job, only the elected one runs it
+    if not is_leader("autodel_cache", ttl=3 * 60):
+        return
     logging.info("doing cache autodelete")
-    # Check if Mongo is being used
-    if settings.USE_MONGO:
-        # logic to delete files from MongoDB
-        # Get the current time
-        now = datetime.now()
-        # Get the files from the database
-        files = cachefs.find({"metadata.uploadDate": {"$lt": now - timedelta(seconds=settings.MAX_TMP_FILE_AGE)}})
-        # Loop through all the files
-        for file in files:
-            logging.info(f"deleting cache {file.filename}")
-            # Check if the file is older than MAX_TMP_FILE_AGE
-            cachefs.delete(file._id)
-    else:
-        # Get the cache directory path
-        cache_dir = settings.CACHE_DIR
-        # Get the current time
-        now = datetime.now()
-
-        # Loop through all the files in the cache directory
-        for filename in os.listdir(cache_dir):
-            file_path = os.path.join(cache_dir, filename)
-
-            # Check if the file is older than MAX_TMP_FILE_AGE
-            if os.stat(file_path).st_mtime < (now - timedelta(seconds=settings.MAX_TMP_FILE_AGE)).timestamp():
-                os.remove(file_path)
-                logging.info(f"deleting cache {filename}")
+    with metrics.AUTODEL_SECONDS.time():
+        if settings.USE_MONGO:
+            evict_gridfs()
+        else:
+            evict_files()
+
+
+def _evicted(size: int):
+    metrics.AUTODEL_FILES.inc()
+    metrics.AUTODEL_BYTES.inc(size)
+
+
+def _over_budget(count: int, size: int) -> bool:
+    max_size = settings.CACHE_MAX_SIZE_MB * 1024 * 1024
+    return (max_size > 0 and size > max_size) or (settings.CACHE_MAX_ENTRIES > 0 and count > settings.CACHE_MAX_ENTRIES)
+
+
+def evict_files():
+    """
+    The evict_files function deletes files from CACHE_DIR that were not accessed
+    for MAX_TMP_FILE_AGE seconds, then the least recently used ones until the cache
+    fits in CACHE_MAX_SIZE_MB and CACHE_MAX_ENTRIES.
+    """
+    if cache_index.needs_rebuild():
+        cache_index.rebuild()
+
+    if settings.MAX_TMP_FILE_AGE:
+        accessed_before = time.time() - settings.MAX_TMP_FILE_AGE
+        while expired := cache_index.least_recently_used(EVICT_BATCH, accessed_before):
+            for filename, size in expired:
+                _delete_file(filename, size)
+
+    count, size = cache_index.usage()
+    while _over_budget(count, size):
+        oldest = cache_index.least_recently_used(EVICT_BATCH)
+        if not oldest:
+            break
+        for filename, file_size in oldest:
+            _delete_file(filename, file_size)
+            count, size = count - 1, size - file_size
+            if not _over_budget(count, size):
+                break
+
+
+def _delete_file(filename: str, size: int):
+    logging.info(f"deleting cache {filename}")
+    path = find_path(settings.CACHE_DIR, filename)
+    if path:
+        os.remove(path)
+        _evicted(size)
+    cache_index.remove(filename)
+
+
+def evict_gridfs():
+    """
+    The evict_gridfs function applies the same policy as evict_files to the
+    GridFS cache, using the indexed metadata.lastAccess of each file.
+    """
+    files = db["cache.files"]
+
+    if settings.MAX_TMP_FILE_AGE:
+        accessed_before = datetime.now() - timedelta(seconds=settings.MAX_TMP_FILE_AGE)
+        expired = files.find({"$or": [
+            {"metadata.lastAccess": {"$lt": accessed_before}},
+            # cached before accesses were recorded
+            {"metadata.lastAccess": {"$exists": False}, "metadata.uploadDate": {"$lt": accessed_before}},
+        ]}, {"filename": 1, "length": 1})
+        for file in expired:
+            logging.info(f"deleting cache {file['filename']}")
+            cachefs.delete(file["_id"])
+            _evicted(file["length"])
+
+    usage = next(files.aggregate([{"$group": {"_id": None, "count": {"$sum": 1}, "size": {"$sum": "$length"}}}]), None)
+    if not usage:
+        return
+    count, size = usage["count"], usage["size"]
+    if not _over_budget(count, size):
+        return
+    for file in files.find({}, {"filename": 1, "length": 1}).sort("metadata.lastAccess", 1):
+        logging.info(f"deleting cache {file['filename']}")
+        cachefs.delete(file["_id"])
+        _evicted(file["length"])
+        count, size = count - 1, size - file["length"]
+        if not _over_budget(count, size):
+            break
@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+from flask import Response, request
+import imgpush.settings as settings
+
+
+def get_cache_control() -> str:
+    """
+    The get_cache_control function builds the Cache-Control header for image
+    responses. Images are never modified in place, so they can be cached for
+    CACHE_MAX_AGE seconds and marked immutable.
+
+    :return: The value of the Cache-Control header
+    """
+    directives = ["private" if settings.GET_REQUIRE_AUTH is True else "public", f"max-age={settings.CACHE_MAX_AGE}"]
+    if settings.CACHE_IMMUTABLE is True:
+        directives.append("immutable")
+    return ", ".join(directives)
+
+
+def _as_utc(date: datetime) -> datetime:
+    # GridFS upload dates are naive UTC datetimes
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.replace(microsecond=0)
+
+
+def is_not_modified(etag: str, last_modified: datetime | None) -> bool:
+    """
+    The is_not_modified function checks the If-None-Match and If-Modified-Since
+    headers of the request against the validators of the image.
+
+    :param etag: str: The strong ETag of the image
+    :param last_modified: datetime | None: When the image was stored
+    :return: True if the client's copy is still valid
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return _as_utc(last_modified) <= request.if_modified_since
+    return False
+
+
+def add_cache_headers(resp: Response, etag: str, last_modified: datetime | None) -> Response:
+    """
+    The add_cache_headers function sets the ETag, Last-Modified and
+    Cache-Control headers of an image response.
+    """
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = _as_utc(last_modified)
+    resp.headers["Cache-Control"] = get_cache_control()
+    if settings.NEGOTIATE_FORMATS:
+        resp.vary.add("Accept")
+    return resp
+
+
+def not_modified(etag: str, last_modified: datetime | None) -> Response:
+    """
+    The not_modified function builds the 304 response for a still valid image.
+    """
+    return add_cache_headers(Response(status=304), etag, last_modified)
@@ -1,10 +1,16 @@
+import os
 import imgpush.settings as settings
-from PIL import Image
+from PIL import Image, features
+from werkzeug.datastructures import MIMEAccept
+
+# formats that can be negotiated, smallest first, skipping those this Pillow build cannot encode
+NEGOTIABLE_FORMATS = [file_format.lower() for file_format in settings.NEGOTIATE_FORMATS
+                      if features.check(file_format.lower())]
 
 def convert_format_type(file_format: str, default_format: str = settings.OUTPUT_TYPE):
     file_format = file_format.upper()
 
-    acceptable_formats = ['JPEG', 'JPG', 'PNG', 'BMP', 'GIF', 'JIFF', 'TIFF', 'WEBP']
+    acceptable_formats = ['JPEG', 'JPG', 'PNG', 'BMP', 'GIF', 'JIFF', 'TIF', 'TIFF', 'WEBP', 'AVIF']
 
     # Check if the output type is an acceptable format
     if file_format not in acceptable_formats:
@@ -13,8 +19,32 @@ def convert_format_type(file_format: str, default_format: str = settings.OUTPUT_
     if file_format in ('JPG', 'JIFF'):
         return "JPEG"
 
+    if file_format == 'TIF':
+        return "TIFF"
+
     return file_format
 
+def negotiate_format(filename: str, accept: MIMEAccept) -> str | None:
+    """
+    The negotiate_format function picks the first of NEGOTIATE_FORMATS that the
+    client explicitly accepts and that is smaller than the format the image is stored in.
+
+    :param filename: str: The filename of the stored image
+    :param accept: MIMEAccept: The parsed Accept header of the request
+    :return: The format to convert the image to, or None to keep it
+    """
+    current_format = convert_format_type(os.path.splitext(filename)[1][1:])
+    accepted = {value.lower() for value, quality in accept if quality > 0}
+    for file_format in NEGOTIABLE_FORMATS:
+        if convert_format_type(file_format) == current_format:
+            return None
+        # only GIF and WebP animations are encoded, converting to other formats would drop the animation
+        if current_format == "GIF" and convert_format_type(file_format) != "WEBP":
+            continue
+        if f"image/{file_format}" in accepted:
+            return file_format
+    return None
+
 def convert_image(image: Image.Image, output_format: str):
     output_format = convert_format_type(output_format)
 
@@ -22,7 +52,9 @@ def convert_image(image: Image.Image, output_format: str):
     if output_format == 'JPEG':
         mode = 'RGB'
     elif output_format == 'PNG':
-        mode = 'RGBA'
+        # an alpha band of an opaque image would only make the file larger
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        mode = image.mode if image.mode in ('L', 'P', 'RGB', 'RGBA') else 'RGBA' if has_alpha else 'RGB'
     elif output_format == 'GIF':
         mode = 'P'
     else:
@@ -1,9 +1,125 @@
 
+import logging
+import os
+import threading
+from typing import BinaryIO, Callable
 import gridfs
+from gridfs import GridIn, GridOut
 import imgpush.settings as settings
 from pymongo import MongoClient
+from imgpush.lib import metrics
+from pymongo.database import Database
 
-client = MongoClient(settings.MONGO_URI) if settings.USE_MONGO else None
-db = client["imgpush"] if settings.USE_MONGO else None
-fs: gridfs.GridFS = gridfs.GridFS(db, "images") if settings.USE_MONGO else None
-cachefs: gridfs.GridFS = gridfs.GridFS(db, "cache") if settings.USE_MONGO else None
+_client: MongoClient | None = None
+_client_pid: int | None = None
+_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    """
+    The get_client function returns the MongoClient of the current process,
+    creating it on first use. A client must not be used across a fork, so a
+    forked worker gets its own client and connection pool instead of the parent's.
+
+    :return: The MongoClient shared by the threads of this process
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = MongoClient(settings.MONGO_URI)
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_db() -> Database:
+    return get_client()["imgpush"]
+
+
+class _Lazy:
+    """
+    Stands in for an object created by factory on first use in each process,
+    so importing a module that uses the database does not connect to it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._pid = None
+
+    def _get(self):
+        if self._instance is None or self._pid != os.getpid():
+            self._instance = self._factory()
+            self._pid = os.getpid()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+
+db: Database = _Lazy(get_db) if settings.USE_MONGO else None
+fs: gridfs.GridFS = _Lazy(lambda: gridfs.GridFS(get_db(), "images")) if settings.USE_MONGO else None
+cachefs: gridfs.GridFS = _Lazy(lambda: gridfs.GridFS(get_db(), "cache")) if settings.USE_MONGO else None
+variantsfs: gridfs.GridFS = _Lazy(lambda: gridfs.GridFS(get_db(), "variants")) if settings.USE_MONGO else None
+
+
+def find_file(bucket: gridfs.GridFS, filename: str) -> GridOut | None:
+    """
+    The find_file function resolves a filename to a readable GridOut in a single
+    indexed query, instead of exists + find_one + get. The returned GridOut already
+    holds the file document, so only reading its content costs further round trips.
+
+    :param bucket: gridfs.GridFS: The bucket to search (fs, cachefs or variantsfs)
+    :param filename: str: The filename of the file
+    :return: The file, or None if it does not exist
+    """
+    with metrics.stage("gridfs_find"):
+        return bucket.find_one({"filename": filename})
+
+
+def put_file(bucket: gridfs.GridFS, save: Callable[[BinaryIO], object], **kwargs) -> GridIn:
+    """
+    The put_file function stores a file written by save straight into GridFS.
+    Unlike a GridIn used as a context manager, the chunks already written are
+    deleted when save fails or the filename is taken (FileExists), instead of
+    being left without a file document.
+
+    :param bucket: gridfs.GridFS: The bucket to store the file in
+    :param save: Callable: Writes the contents of the file into the file object it is given
+    :param kwargs: The filename, metadata and other fields of the file document
+    :return: The closed GridIn, holding the _id of the file
+    """
+    grid_in = bucket.new_file(**kwargs)
+    try:
+        save(grid_in)
+        grid_in.close()
+    except BaseException:
+        grid_in.abort()
+        raise
+    return grid_in
+
+
+def ensure_indexes(database=None):
+    """
+    Creates the indexes imgpush relies on at startup. The unique filename indexes
+    make find_file a single index lookup and stop concurrent workers from storing
+    the same file twice.
+
+    :param database: The database to create the indexes in, defaults to the imgpush database
+    """
+    if database is None:
+        if not settings.USE_MONGO:
+            return
+        database = get_db()
+    for collection in ("images.files", "cache.files", "variants.files"):
+        try:
+            database[collection].create_index("filename", unique=True)
+        except Exception as e:
+            logging.warning(f"Failed to create unique index on {collection}.filename: {e}")
+    database["variants.files"].create_index("metadata.original")
+    database["cache.files"].create_index("metadata.lastAccess")
+    # the uploaded files the blobs of DEDUPLICATE_UPLOADS were encoded from
+    database["images.files"].create_index("metadata.sources", sparse=True)
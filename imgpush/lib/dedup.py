@@ -0,0 +1,364 @@
+"""
+Content-addressed storage of uploads, enabled by DEDUPLICATE_UPLOADS.
+
+Every distinct encoded image is stored once, as a blob named after the SHA-256
+of its contents, and every upload of it gets its own random name, an alias of
+the blob. Variants and resized images are keyed by the blob, so they are shared
+by every alias too. The blob is deleted with its variants when its last alias is.
+
+On the filesystem the blobs are stored in IMAGES_DIR/.blobs and every alias is
+a hard link to its blob, so aliases are served like any other image. A SQLite
+index shared by the worker processes maps the aliases to their blob. In GridFS
+the blobs are stored in the images bucket under .blobs/<digest>.<ext>, with the
+number of aliases in metadata.refs, and the aliases in the aliases collection.
+
+The digest of every uploaded file is recorded with its blob, so uploading the
+same file again adds an alias without decoding nor encoding it.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import BinaryIO, Callable
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import imgpush.settings as settings
+from imgpush.lib import metrics
+from imgpush.lib.db import db, fs, put_file
+from imgpush.lib.encode_options import profile_key
+from imgpush.lib.errors import CollisionError
+from imgpush.lib.filename import find_path, get_random_filename, get_shard_path
+from imgpush.lib.pregenerate import delete_variants, pregenerate
+from imgpush.lib.utils import atomic_save
+
+BLOBS_DIR = os.path.join(settings.IMAGES_DIR, ".blobs")
+BLOB_PREFIX = ".blobs/"
+# how many random names an upload tries before giving up, as in upload.py
+MAX_NAME_ATTEMPTS = 5
+# how many times a GridFS upload retries while the blob it duplicates is being deleted
+MAX_BLOB_ATTEMPTS = 5
+CHUNK_SIZE = 1024 * 1024
+
+
+class DedupIndex:
+    """
+    A SQLite index of the aliases of the blobs in IMAGES_DIR/.blobs and of the
+    uploaded files each blob was encoded from. Changes are made in immediate
+    transactions, so the worker processes never add an alias to a blob that
+    another one is deleting.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # connections can be shared neither between threads nor across a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS aliases (filename TEXT PRIMARY KEY, blob TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS aliases_blob ON aliases (blob)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, blob TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sources_blob ON sources (blob)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def blob(self, filename: str) -> str | None:
+        row = self._conn().execute("SELECT blob FROM aliases WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row else None
+
+
+index = DedupIndex(os.path.join(settings.IMAGES_DIR, ".dedup.sqlite"))
+
+
+class HashingWriter:
+    """
+    Wraps a writable file object and hashes everything written to it. It has
+    no fileno, so Pillow encodes through write instead of the file descriptor.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.digest = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.fp.write(data)
+
+    def flush(self):
+        pass
+
+
+def source_key(stream: BinaryIO, output_type: str) -> str:
+    """
+    The source_key function returns the key under which the blob encoded from
+    an uploaded file is recorded, the SHA-256 of the file and of the options
+    its encoding depends on.
+
+    :param stream: BinaryIO: The seekable upload, rewound afterwards
+    :param output_type: str: The type the upload is stored as
+    :return: The key of the upload
+    """
+    digest = hashlib.sha256(f"{output_type.lower()}:{settings.PASSTHROUGH_UPLOADS}:{profile_key()}:".encode())
+    while chunk := stream.read(CHUNK_SIZE):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def blob_filename(blob: str) -> str:
+    """
+    Returns the GridFS filename of a blob, which no image url can request.
+    """
+    return BLOB_PREFIX + blob
+
+
+def _blob_path(blob: str) -> str:
+    return get_shard_path(BLOBS_DIR, blob)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def canonical(filename: str) -> str | None:
+    """
+    The canonical function returns the blob an image is an alias of.
+
+    :param filename: str: The public filename of the image
+    :return: The filename of the blob, or None if the image was not deduplicated
+    """
+    if settings.USE_MONGO:
+        alias = db.aliases.find_one({"_id": filename}, {"blob": True})
+        return alias["blob"] if alias else None
+    return index.blob(filename)
+
+
+def link_source(source: str, name: str, extension: str) -> str | None:
+    """
+    The link_source function stores an upload as a new alias of the blob that
+    was encoded from the same file before, without decoding it.
+
+    :param source: str: The key of the upload, see source_key
+    :param name: str: The random name of the image, without extension
+    :param extension: str: The extension of the image, without dot
+    :return: The filename the image was stored under, or None if the file was never uploaded
+    """
+    if settings.USE_MONGO:
+        blob = db["images.files"].find_one_and_update({"metadata.sources": source, "metadata.refs": {"$gt": 0}},
+                                                      {"$inc": {"metadata.refs": 1}}, {"filename": True})
+        if blob is None:
+            return None
+        blob = blob["filename"][len(BLOB_PREFIX):]
+        filename = _add_gridfs_alias(f"{name}.{extension}", blob)
+    else:
+        with index.transaction() as conn:
+            row = conn.execute("SELECT blob FROM sources WHERE source = ?", (source,)).fetchone()
+            if row is None or not os.path.isfile(_blob_path(row[0])):
+                return None
+            blob = row[0]
+            filename = _add_file_alias(conn, f"{name}.{extension}", blob)
+    metrics.DEDUP_UPLOADS.inc(result="same_file")
+    logging.info(f"Stored file {filename} as an alias of {blob}")
+    return filename
+
+
+def store(filename: str, mimetype: str, save: Callable[[BinaryIO], object], source: str) -> str:
+    """
+    The store function encodes an upload and stores it as an alias of the blob
+    with the same contents, creating the blob and pregenerating its variants if
+    it does not exist yet.
+
+    :param filename: str: The filename to store the image under
+    :param mimetype: str: The mimetype of the image
+    :param save: Callable: Writes the encoded image into the file object it is given
+    :param source: str: The key of the upload, see source_key
+    :return: The filename the image was stored under
+    """
+    if settings.USE_MONGO:
+        return _store_gridfs(filename, mimetype, save, source)
+    return _store_file(filename, mimetype, save, source)
+
+
+def _store_file(filename: str, mimetype: str, save: Callable[[BinaryIO], object], source: str) -> str:
+    extension = os.path.splitext(filename)[1]
+    tmp_path = os.path.join(BLOBS_DIR, f"{get_random_filename()}{extension}.{os.getpid()}.tmp")
+    try:
+        atomic_save(tmp_path, save)
+        blob = _file_digest(tmp_path) + extension
+        path = _blob_path(blob)
+        with index.transaction() as conn:
+            created = not os.path.isfile(path)
+            if created:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            filename = _add_file_alias(conn, filename, blob)
+            conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (source, blob))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _stored(filename, blob, created)
+    if created:
+        pregenerate(blob, path, mimetype)
+    return filename
+
+
+def _add_file_alias(conn: sqlite3.Connection, filename: str, blob: str) -> str:
+    extension = os.path.splitext(filename)[1]
+    for _ in range(MAX_NAME_ATTEMPTS):
+        path = get_shard_path(settings.IMAGES_DIR, filename)
+        try:
+            # images from before the sharded layout may still be stored flat
+            if os.path.exists(os.path.join(settings.IMAGES_DIR, filename)):
+                raise FileExistsError
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.link(_blob_path(blob), path)
+            break
+        except FileExistsError:
+            filename = get_random_filename() + extension
+    else:
+        raise CollisionError
+    conn.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?)", (filename, blob))
+    return filename
+
+
+def _store_gridfs(filename: str, mimetype: str, save: Callable[[BinaryIO], object], source: str) -> str:
+    files = db["images.files"]
+    extension = os.path.splitext(filename)[1]
+    writer = None
+
+    def hashing_save(grid_in: BinaryIO):
+        nonlocal writer
+        writer = HashingWriter(grid_in)
+        save(writer)
+
+    # stored under a temporary name until its digest is known
+    grid_in = put_file(fs, hashing_save, filename=blob_filename(f"{get_random_filename()}{extension}.tmp"),
+                       metadata={"type": mimetype, "uploadDate": datetime.now(), "refs": 0})
+    blob = writer.digest.hexdigest() + extension
+
+    created = False
+    try:
+        for _ in range(MAX_BLOB_ATTEMPTS):
+            try:
+                files.update_one({"_id": grid_in._id}, {"$set": {"filename": blob_filename(blob), "metadata.refs": 1,
+                                                                 "metadata.sources": [source]}})
+                created = True
+                break
+            except DuplicateKeyError:
+                pass
+            result = files.update_one({"filename": blob_filename(blob), "metadata.refs": {"$gt": 0}},
+                                      {"$inc": {"metadata.refs": 1}, "$addToSet": {"metadata.sources": source}})
+            if result.modified_count:
+                break
+            # the blob lost its last alias, its deletion is taken over unless it has already removed the file
+            result = files.update_one({"filename": blob_filename(blob), "metadata.refs": {"$lte": 0}},
+                                      {"$set": {"metadata.refs": 1}, "$addToSet": {"metadata.sources": source}})
+            if result.modified_count:
+                break
+        else:
+            raise CollisionError
+    finally:
+        if not created:
+            fs.delete(grid_in._id)
+
+    filename = _add_gridfs_alias(filename, blob)
+    _stored(filename, blob, created)
+    if created:
+        pregenerate(blob, None, mimetype, blob_filename(blob))
+    return filename
+
+
+def _add_gridfs_alias(filename: str, blob: str) -> str:
+    extension = os.path.splitext(filename)[1]
+    for _ in range(MAX_NAME_ATTEMPTS):
+        if fs.exists(filename=filename):
+            filename = get_random_filename() + extension
+            continue
+        try:
+            db.aliases.insert_one({"_id": filename, "blob": blob, "uploadDate": datetime.now()})
+            return filename
+        except DuplicateKeyError:
+            filename = get_random_filename() + extension
+    _release_gridfs_blob(blob)
+    raise CollisionError
+
+
+def _stored(filename: str, blob: str, created: bool):
+    metrics.DEDUP_UPLOADS.inc(result="new" if created else "same_image")
+    if created:
+        logging.info(f"Stored blob {blob} for file {filename}")
+    else:
+        logging.info(f"Stored file {filename} as an alias of {blob}")
+
+
+def release(filename: str) -> bool:
+    """
+    The release function deletes an alias, and its blob with the variants of
+    the blob when it was the last alias.
+
+    :param filename: str: The public filename of the image
+    :return: Whether the image was an alias, False if it must be deleted like any other image
+    """
+    if settings.USE_MONGO:
+        alias = db.aliases.find_one_and_delete({"_id": filename})
+        if alias is None:
+            return False
+        _release_gridfs_blob(alias["blob"])
+        return True
+
+    path = find_path(settings.IMAGES_DIR, filename)
+    with index.transaction() as conn:
+        row = conn.execute("SELECT blob FROM aliases WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return False
+        blob = row[0]
+        conn.execute("DELETE FROM aliases WHERE filename = ?", (filename,))
+        if path:
+            os.remove(path)
+        deleted = conn.execute("SELECT 1 FROM aliases WHERE blob = ? LIMIT 1", (blob,)).fetchone() is None
+        if deleted:
+            conn.execute("DELETE FROM sources WHERE blob = ?", (blob,))
+            try:
+                os.remove(_blob_path(blob))
+            except FileNotFoundError:
+                pass
+    if deleted:
+        delete_variants(blob)
+        logging.info(f"Deleted blob {blob}, {filename} was its last alias")
+    return True
+
+
+def _release_gridfs_blob(blob: str):
+    document = db["images.files"].find_one_and_update({"filename": blob_filename(blob)},
+                                                      {"$inc": {"metadata.refs": -1}}, {"metadata.refs": True},
+                                                      return_document=ReturnDocument.AFTER)
+    if document is None or document["metadata"]["refs"] > 0:
+        return
+    # an upload of the same image may have taken the blob over in the meantime
+    if db["images.files"].delete_one({"_id": document["_id"], "metadata.refs": {"$lte": 0}}).deleted_count:
+        db["images.chunks"].delete_many({"files_id": document["_id"]})
+        delete_variants(blob)
+        logging.info(f"Deleted blob {blob}, its last alias was deleted")
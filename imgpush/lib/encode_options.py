@@ -0,0 +1,113 @@
+from PIL import Image
+import imgpush.settings as settings
+from imgpush.lib.convert_format import convert_format_type
+
+# images with at most this many colors in a sample of their pixels are flat graphics
+GRAPHIC_MAX_COLORS = 256
+# side of the sample the colors are counted in
+GRAPHIC_SAMPLE_SIZE = 256
+PALETTE_MODES = ("RGB",)
+
+# the quality of Pillow, with the options that make files smaller without changing their pixels
+DEFAULT_ORIGINAL_OPTIONS = {
+    "JPEG": {"quality": 75, "optimize": True, "progressive": True},
+    # optimizing a large PNG takes several times longer than encoding it, uploads keep the default level
+    "PNG": {},
+    "WEBP": {"quality": 80, "method": 4},
+}
+# variants are encoded once and served many times, so they get the slowest and smallest settings
+DEFAULT_VARIANT_OPTIONS = {
+    "JPEG": {"quality": 75, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+    "WEBP": {"quality": 80, "method": 6},
+}
+
+
+def _profile(defaults: dict, configured: dict) -> dict:
+    # a configured format replaces its defaults, the other formats keep them
+    profile = dict(defaults)
+    profile.update({convert_format_type(file_format): options for file_format, options in configured.items()})
+    return profile
+
+
+PROFILES = {
+    "original": _profile(DEFAULT_ORIGINAL_OPTIONS, settings.ORIGINAL_ENCODE_OPTIONS),
+    "variant": _profile(DEFAULT_VARIANT_OPTIONS, settings.VARIANT_ENCODE_OPTIONS),
+}
+GRAPHIC_OPTIONS = _profile({}, settings.GRAPHIC_ENCODE_OPTIONS)
+
+
+def encode_options(file_format: str, variant: bool = False) -> dict:
+    """
+    The encode_options function returns the Pillow save options of a format,
+    from ORIGINAL_ENCODE_OPTIONS for uploads and VARIANT_ENCODE_OPTIONS for
+    resized and converted images.
+
+    :param file_format: str: The format the image is encoded in
+    :param variant: bool: Whether the image is a resized or converted variant
+    :return: The keyword arguments of Image.save
+    """
+    return PROFILES["variant" if variant else "original"].get(convert_format_type(file_format), {})
+
+
+def is_graphic(img: Image.Image) -> bool:
+    """
+    The is_graphic function tells flat graphics such as logos, screenshots and
+    diagrams from photos, by counting the colors of a sample of the pixels.
+    Sampling with the nearest neighbor never blends colors, so a graphic keeps
+    its few colors while a photo has thousands.
+
+    :param img: Image.Image: The decoded image
+    :return: Whether the image is a flat graphic
+    """
+    sample = img
+    if max(img.size) > GRAPHIC_SAMPLE_SIZE:
+        scale = GRAPHIC_SAMPLE_SIZE / max(img.size)
+        sample = img.resize((max(round(img.width * scale), 1), max(round(img.height * scale), 1)),
+                            Image.Resampling.NEAREST)
+    return sample.getcolors(GRAPHIC_MAX_COLORS) is not None
+
+
+def to_palette(img: Image.Image) -> Image.Image | None:
+    """
+    Returns an opaque image with at most 256 colors as a palette image with
+    exactly the same pixels, or None if it has more colors.
+    """
+    if img.mode not in PALETTE_MODES:
+        return None
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([channel for _count, color in colors for channel in color])
+    # every color is in the palette, so no pixel is approximated
+    return img.quantize(palette=palette, dither=Image.Dither.NONE)
+
+
+def prepare(img: Image.Image, file_format: str, variant: bool = False) -> tuple[Image.Image, dict]:
+    """
+    The prepare function returns the image to encode and its save options. With
+    ADAPTIVE_ENCODING, flat graphics get GRAPHIC_ENCODE_OPTIONS on top of the
+    profile, and are stored as palette images in PNG when they have few enough colors.
+
+    :param img: Image.Image: The decoded image
+    :param file_format: str: The format the image is encoded in
+    :param variant: bool: Whether the image is a resized or converted variant
+    :return: The image and the keyword arguments of Image.save
+    """
+    file_format = convert_format_type(file_format)
+    options = encode_options(file_format, variant)
+    if not settings.ADAPTIVE_ENCODING or not is_graphic(img):
+        return img, options
+    options = {**options, **GRAPHIC_OPTIONS.get(file_format, {})}
+    if file_format == "PNG":
+        img = to_palette(img) or img
+    return img, options
+
+
+def profile_key() -> str:
+    """
+    Returns what the encoding of originals depends on, so that uploads encoded
+    with other options are not taken for the same image.
+    """
+    return repr((PROFILES["original"], settings.ADAPTIVE_ENCODING and GRAPHIC_OPTIONS))
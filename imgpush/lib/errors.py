@@ -4,3 +4,19 @@ class InvalidSize(Exception):
 
 class CollisionError(Exception):
     """Raised when the filename is already present."""
+
+
+class ResizeTimeout(Exception):
+    """Raised when resizing an image takes longer than RESIZE_TIMEOUT."""
+
+
+class ResizeQueueFull(Exception):
+    """Raised when every resize worker is busy and the queue is full."""
+
+
+class FetchError(Exception):
+    """Raised when the image of a URL upload cannot be downloaded."""
+
+
+class FetchRejected(FetchError):
+    """Raised when a URL upload is refused, its message is returned to the client."""
@@ -0,0 +1,217 @@
+import http.client
+import ipaddress
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urljoin, urlparse
+import filetype
+import imgpush.settings as settings
+from imgpush.lib.errors import FetchError, FetchRejected
+from imgpush.lib.upload import SNIFF_SIZE, spooled_file
+
+CHUNK_SIZE = 64 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# content types servers send for images they do not know, the magic bytes decide
+GENERIC_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+# hosts with idle connections kept, the least recently used one is closed beyond it
+MAX_POOLS = 64
+
+
+def _pinned_socket(conn) -> socket.socket:
+    # connect to the address that was checked, not to whatever the hostname resolves to now
+    sock = socket.create_connection((conn.ip, conn.port), conn.timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(conn.read_timeout)
+    return sock
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host: str, port: int, ip: str, connect_timeout: float, read_timeout: float):
+        super().__init__(host, port, timeout=connect_timeout)
+        self.ip = ip
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        self.sock = _pinned_socket(self)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host: str, port: int, ip: str, connect_timeout: float, read_timeout: float):
+        super().__init__(host, port, timeout=connect_timeout, context=ssl.create_default_context())
+        self.ip = ip
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        # the certificate is still verified against the hostname
+        self.sock = self._context.wrap_socket(_pinned_socket(self), server_hostname=self.host)
+
+
+class Fetcher:
+    """
+    Downloads the images of URL uploads into spooled buffers. Every hop resolves
+    the hostname once, refuses non-public addresses and connects to the checked
+    address, so DNS rebinding cannot reach internal services. Downloads are bounded
+    by timeouts and max_size, and rejected as soon as the headers or the first
+    bytes show they are not images. Keep-alive connections are pooled per host.
+    """
+
+    def __init__(self, max_size: int, connect_timeout: float, read_timeout: float, total_timeout: float,
+                 max_redirects: int, pool_size: int, allow_private: bool = False):
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_redirects = max_redirects
+        self.pool_size = pool_size
+        self.allow_private = allow_private
+        self._idle: OrderedDict[tuple, list] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fetch(self, url: str) -> SpooledTemporaryFile:
+        """
+        The fetch function downloads an image, following redirects.
+
+        :param url: str: The http or https URL of the image
+        :return: The downloaded image, seeked to its start
+        """
+        if not isinstance(url, str):
+            raise FetchRejected("Invalid URL")
+        deadline = time.monotonic() + self.total_timeout
+        for _ in range(self.max_redirects + 1):
+            try:
+                parsed = urlparse(url)
+                https = parsed.scheme.lower() == "https"
+                port = parsed.port or (443 if https else 80)
+            except ValueError:
+                raise FetchRejected("Invalid URL")
+            if parsed.scheme.lower() not in ("http", "https") or not parsed.hostname:
+                raise FetchRejected("Invalid URL")
+
+            key = (https, parsed.hostname, port, self._resolve(parsed.hostname, port))
+            path = parsed.path or "/"
+            if parsed.query:
+                path += f"?{parsed.query}"
+
+            conn, response = self._request(key, path)
+            try:
+                if response.status in REDIRECT_STATUSES and response.getheader("Location"):
+                    url = urljoin(url, response.getheader("Location"))
+                    conn.close()
+                    continue
+                if response.status != 200:
+                    raise FetchError(f"Got status {response.status}")
+                stream = self._read(response, deadline)
+            except BaseException:
+                conn.close()
+                raise
+            self._release(key, conn, response)
+            return stream
+        raise FetchRejected("Too many redirects")
+
+    def _resolve(self, hostname: str, port: int) -> str:
+        try:
+            addresses = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError):
+            raise FetchRejected("Failed to resolve host")
+        for *_, sockaddr in addresses:
+            ip = ipaddress.ip_address(sockaddr[0].split("%")[0])
+            if not self.allow_private and not ip.is_global:
+                raise FetchRejected("Refusing to connect to local or private address")
+        return addresses[0][4][0]
+
+    def _request(self, key: tuple, path: str) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        headers = {"User-Agent": "imgpush", "Accept": "image/*"}
+        conn = self._acquire(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                https, hostname, port, ip = key
+                connection_class = _PinnedHTTPSConnection if https else _PinnedHTTPConnection
+                conn = connection_class(hostname, port, ip, self.connect_timeout, self.read_timeout)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                # the server may have closed an idle pooled connection, retry once on a new one
+                if not reused:
+                    raise FetchError(f"Failed to download file: {e}")
+                conn, reused = None, False
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise FetchError(f"Failed to download file: {e}")
+
+    def _read(self, response: http.client.HTTPResponse, deadline: float) -> SpooledTemporaryFile:
+        length = response.getheader("Content-Length")
+        if length and length.isdigit() and int(length) > self.max_size:
+            raise FetchRejected("File is too large")
+        content_type = (response.getheader("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type and not content_type.startswith("image/") and content_type not in GENERIC_CONTENT_TYPES:
+            raise FetchRejected("Invalid Filetype")
+
+        stream = spooled_file()
+        size = 0
+        head = b""
+        try:
+            while True:
+                if time.monotonic() > deadline:
+                    raise FetchError("Download timed out")
+                chunk = response.read1(CHUNK_SIZE)
+                if len(head) < SNIFF_SIZE:
+                    head += chunk[:SNIFF_SIZE - len(head)]
+                    if (not chunk or len(head) >= SNIFF_SIZE) and not filetype.is_image(head):
+                        raise FetchRejected("Invalid Filetype")
+                if not chunk:
+                    # a fully read response with a Content-Length is not closed by read1
+                    response.close()
+                    break
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FetchRejected("File is too large")
+                stream.write(chunk)
+        except (OSError, http.client.HTTPException) as e:
+            stream.close()
+            raise FetchError(f"Failed to download file: {e}")
+        except BaseException:
+            stream.close()
+            raise
+        stream.seek(0)
+        return stream
+
+    def _acquire(self, key: tuple) -> http.client.HTTPConnection | None:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._idle.move_to_end(key)
+                return idle.pop()
+        return None
+
+    def _release(self, key: tuple, conn: http.client.HTTPConnection, response: http.client.HTTPResponse):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        closed = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+            else:
+                closed.append(conn)
+            while len(self._idle) > MAX_POOLS:
+                closed.extend(self._idle.popitem(last=False)[1])
+        for conn in closed:
+            conn.close()
+
+
+fetcher = Fetcher(
+    max_size=settings.MAX_SIZE_MB * 1024 * 1024,
+    connect_timeout=settings.FETCH_CONNECT_TIMEOUT,
+    read_timeout=settings.FETCH_READ_TIMEOUT,
+    total_timeout=settings.FETCH_TOTAL_TIMEOUT,
+    max_redirects=settings.FETCH_MAX_REDIRECTS,
+    pool_size=settings.FETCH_POOL_SIZE,
+)
@@ -1,25 +1,86 @@
 import imgpush.settings as settings
-import glob
+import hashlib
+import os
 import random
 import string
 import uuid
+from typing import Iterator
 
 def get_random_filename():
     """
     The _get_random_filename function generates a random filename for an image.
-    It does this by generating a random string of length settings.RANDOM_STRING_LENGTH,
-    and then appending the appropriate file extension based on the MIME type of the image.
-    If that filename already exists in IMAGES_DIR, it will generate another one and check if it exists again.
+    It does this by generating a random string of length settings.RANDOM_STRING_LENGTH.
+    Collisions are not checked here, the upload is written with an exclusive create
+    and picks another name if the path is already taken.
 
     :return: A random string of length 8
     :doc-author: Trelent
     """
-    random_string = generate_random_filename()
-    if settings.NAME_STRATEGY == "randomstr":
-        file_exists = len(glob.glob(f"{settings.IMAGES_DIR}/{random_string}.*")) > 0
-        if file_exists:
-            return get_random_filename()
-    return random_string
+    return generate_random_filename()
+
+
+def get_shard_path(directory: str, filename: str) -> str:
+    """
+    The get_shard_path function returns where a file is stored in the sharded
+    layout, two levels of directories named after the hash of the filename,
+    e.g. IMAGES_DIR/ab/cd/name.png, so no directory grows to millions of entries.
+
+    :param directory: str: IMAGES_DIR, CACHE_DIR or VARIANTS_DIR
+    :param filename: str: The public filename of the file
+    :return: The path of the file
+    """
+    digest = hashlib.md5(filename.encode(), usedforsecurity=False).hexdigest()
+    return os.path.join(directory, digest[:2], digest[2:4], filename)
+
+
+def find_path(directory: str, filename: str) -> str | None:
+    """
+    The find_path function returns the path of an existing file, looking in the
+    sharded layout first and then in the flat layout of directories that have not
+    been migrated yet (see lib/migrate/flat_to_sharded.py).
+
+    :param directory: str: IMAGES_DIR, CACHE_DIR or VARIANTS_DIR
+    :param filename: str: The public filename of the file
+    :return: The path of the file, or None if it does not exist
+    """
+    for path in (get_shard_path(directory, filename), os.path.join(directory, filename)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def iter_files(directory: str) -> Iterator[tuple[str, str]]:
+    """
+    The iter_files function yields the (filename, path) of every stored file in
+    directory, in both the flat and sharded layouts, skipping internal files
+    and directories, such as the blobs of deduplicated uploads.
+
+    :param directory: str: IMAGES_DIR, CACHE_DIR or VARIANTS_DIR
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        for filename in files:
+            if filename.startswith(".") or filename.endswith((".tmp", ".lock")):
+                continue
+            yield filename, os.path.join(root, filename)
+
+
+def get_resized_filename(filename: str, width, height, output_format: str | None = None) -> str:
+    """
+    The get_resized_filename function returns the name under which the
+    resized variant of an image is stored, e.g. name_64x64.png, or
+    name_64x64.webp when it is converted to another format.
+
+    :param filename: str: The filename of the original image
+    :param width: The requested width, or ""
+    :param height: The requested height, or ""
+    :param output_format: str | None: The format the variant is converted to
+    :return: The filename of the resized variant
+    """
+    filename_without_extension, extension = os.path.splitext(filename)
+    if output_format:
+        extension = f".{output_format}"
+    return filename_without_extension + f"_{width}x{height}{extension}"
 
 
 def generate_random_filename():
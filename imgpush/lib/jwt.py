@@ -1,6 +1,114 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 import python_jwt as jwt
 import jwcrypto.jwk as jwk
-import settings
+import imgpush.settings as settings
+
+# how often the public key file is checked for changes, in seconds
+KEY_CHECK_INTERVAL = 1
+
+
+class TokenVerifier:
+    """
+    Verifies jwt tokens with a key that is parsed once, and reloaded when the
+    public key file changes. The claims of verified tokens are kept in a bounded
+    LRU cache until the cache ttl or the exp claim of the token, whichever comes
+    first, so repeated requests with the same token skip signature verification.
+    """
+
+    def __init__(self, public_key: str | None, secret: str | None, algorithm: str | None,
+                 cache_size: int, cache_ttl: float):
+        self.public_key = public_key
+        self.secret = secret
+        self.algorithm = algorithm or ("RS256" if public_key else "HS256")
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._key = None
+        self._key_stat = None
+        self._key_checked = 0.0
+        # bumped on every key reload, tokens verified with an older key are not trusted
+        self._generation = 0
+        self._tokens: OrderedDict[str, tuple[dict, float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.public_key or self.secret)
+
+    def verify(self, token: str) -> dict | None:
+        """
+        The verify function takes a token as an argument and returns the claims
+        if the token is valid, otherwise it returns None.
+
+        :param token: str: Pass in the jwt token
+        :return: A dictionary of claims if the token is valid, or none otherwise
+        """
+        if not self.enabled or not token:
+            return None
+        try:
+            key, generation = self._get_key()
+            claims = self._cached(token, generation)
+            if claims is not None:
+                return claims
+            (_header, claims) = jwt.verify_jwt(token, pub_key=key, allowed_algs=[self.algorithm],
+                                               checks_optional=True)
+        except Exception:
+            return None
+        self._put(token, claims, generation)
+        return claims
+
+    def _get_key(self) -> tuple[jwk.JWK, int]:
+        now = time.monotonic()
+        if self._key is not None and (not self.public_key or now - self._key_checked < KEY_CHECK_INTERVAL):
+            return self._key, self._generation
+        with self._lock:
+            if not self.public_key:
+                if self._key is None:
+                    self._key = jwk.JWK.from_password(self.secret)
+                return self._key, self._generation
+            self._key_checked = now
+            stat = os.stat(self.public_key)
+            key_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if key_stat != self._key_stat:
+                with open(self.public_key, "rb") as pub_key:
+                    self._key = jwk.JWK.from_pem(pub_key.read())
+                self._key_stat = key_stat
+                self._generation += 1
+                self._tokens.clear()
+            return self._key, self._generation
+
+    def _cached(self, token: str, generation: int) -> dict | None:
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            claims, expires, entry_generation = entry
+            if entry_generation != generation or time.time() >= expires:
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return claims
+
+    def _put(self, token: str, claims: dict, generation: int):
+        if self.cache_size <= 0:
+            return
+        expires = time.time() + self.cache_ttl
+        exp = claims.get("exp")
+        if isinstance(exp, (int, float)):
+            expires = min(expires, exp)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._tokens[token] = (claims, expires, generation)
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.cache_size:
+                self._tokens.popitem(last=False)
+
+
+verifier = TokenVerifier(settings.JWT_PUBLIC_KEY, settings.JWT_SECRET, settings.JWT_ALGORITHM,
+                         settings.JWT_CACHE_SIZE, settings.JWT_CACHE_TTL)
 
 
 def verify(token: str) -> dict | None:
@@ -13,18 +121,4 @@ def verify(token: str) -> dict | None:
     :return: A dictionary of claims if the token is valid, or none otherwise
     :doc-author: Trelent
     """
-    if settings.JWT_PUBLIC_KEY or settings.JWT_SECRET:
-        try:
-            claims = None
-            if settings.JWT_PUBLIC_KEY:
-                with open(settings.JWT_PUBLIC_KEY, "rb") as pub_key:
-                    (_header, claims) = jwt.verify_jwt(token, pub_key=jwk.JWK.from_pem(pub_key.read()),
-                                                       allowed_algs=[settings.JWT_ALGORITHM or "RS256"], checks_optional=True)
-            else:
-                (_header, claims) = jwt.verify_jwt(token, pub_key=jwk.JWK.from_password(settings.JWT_SECRET),
-                                                   allowed_algs=[settings.JWT_ALGORITHM or "HS256"], checks_optional=True)
-            return claims
-        except Exception:
-            return None
-    else:
-        return None
+    return verifier.verify(token)
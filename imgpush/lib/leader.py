@@ -0,0 +1,57 @@
+import fcntl
+import os
+import socket
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+import imgpush.settings as settings
+from imgpush.lib.db import db
+
+# name -> (pid, file) of the lock files held by this process
+_lock_files: dict = {}
+
+
+def is_leader(name: str, ttl: int) -> bool:
+    """
+    The is_leader function elects a single process to run the job called name.
+    With mongo the leader holds a lease in the locks collection, renewed on every
+    call and taken over by another worker once it is ttl seconds old. Without
+    mongo it holds an exclusive lock on a file in CACHE_DIR until it exits.
+
+    :param name: str: The name of the job
+    :param ttl: int: Seconds after which the lease of a silent leader expires
+    :return: True if this process should run the job
+    """
+    if settings.USE_MONGO:
+        return _renew_lease(name, ttl)
+    return _hold_lock_file(name)
+
+
+def _renew_lease(name: str, ttl: int) -> bool:
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    now = datetime.now()
+    try:
+        db["locks"].find_one_and_update(
+            {"_id": name, "$or": [{"expires": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def _hold_lock_file(name: str) -> bool:
+    held = _lock_files.get(name)
+    if held and held[0] == os.getpid():
+        return True
+    # a forked child shares the parent's lock, it has to take its own
+    _lock_files.pop(name, None)
+
+    fp = open(os.path.join(settings.CACHE_DIR, f".{name}.leader"), "a")
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fp.close()
+        return False
+    _lock_files[name] = (os.getpid(), fp)
+    return True
@@ -0,0 +1,101 @@
+import threading
+from datetime import datetime
+from collections import OrderedDict
+import imgpush.settings as settings
+
+
+class MemoryCache:
+    """
+    A byte-budgeted, thread-safe LRU cache for encoded images.
+    Entries are keyed on (filename, width, height, format) and hold the
+    image bytes together with their mimetype and cache validators.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._keys_by_filename: dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def accepts(self, size: int) -> bool:
+        """
+        Whether an entry of the given size in bytes may be stored in the cache.
+        """
+        return self.enabled and size <= min(self.max_entry_bytes, self.max_bytes)
+
+    def get(self, key: tuple) -> tuple[bytes, str, str, datetime | None] | None:
+        """
+        Returns the (data, mimetype, etag, last_modified) stored under key and
+        marks it as most recently used, or None if the key is not cached.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, data: bytes, mimetype: str, etag: str, last_modified: datetime | None):
+        """
+        Stores data under key, evicting the least recently used entries
+        until the cache fits in its byte budget.
+        """
+        if not self.accepts(len(data)):
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (data, mimetype, etag, last_modified)
+            self._keys_by_filename.setdefault(key[0], set()).add(key)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, filename: str):
+        """
+        Removes every cached entry (original and variants) of filename.
+        """
+        with self._lock:
+            for key in list(self._keys_by_filename.get(filename, ())):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_size": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        keys = self._keys_by_filename[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_filename[key[0]]
+
+
+memory_cache = MemoryCache(
+    int(settings.MEMORY_CACHE_SIZE_MB * 1024 * 1024),
+    int(settings.MEMORY_CACHE_MAX_ENTRY_KB * 1024),
+)
@@ -0,0 +1,276 @@
+import bisect
+import fcntl
+import hashlib
+import itertools
+import logging
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+import imgpush.settings as settings
+from imgpush.lib.utils import shared_memory_path
+
+logger = logging.getLogger(__name__)
+
+# processes that can record metrics at once, gunicorn workers and their resize workers
+MAX_PROCESSES = 512
+DOUBLE = 8
+# seconds, from a small image read from the page cache to a resize that times out
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+ENDPOINTS = ("upload_image", "batch_upload", "get_image", "delete_image", "liveness", "stats", "metrics", "other")
+STAGES = ("sniff", "decode", "resize_wait", "resize", "encode", "storage_read", "storage_write", "gridfs_find")
+
+_open_lock = threading.Lock()
+
+
+def _after_fork():
+    # a thread of the parent may have held the lock while forking
+    global _open_lock
+    _open_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class Registry:
+    """
+    The values of every metric, in a memory-mapped file shared by the worker
+    processes on the host. The file holds one slab of values per process: a
+    process claims a free slab with a lock on its first byte, held until the
+    process exits, so it updates its values without taking any lock another
+    process waits for. /metrics sums the slabs of every process that ever
+    recorded a value. A slab released by a process is claimed again with the
+    values it holds, so the sums never go backwards when workers are replaced.
+    """
+
+    def __init__(self):
+        self.metrics: list["Metric"] = []
+        # index 0 of a slab marks it as claimed once
+        self.size = 1
+        self._values = None
+        self._fd = None
+        self._slab = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric", size: int) -> int:
+        self.metrics.append(metric)
+        self.size += size
+        return self.size - size
+
+    def path(self) -> str:
+        # the layout is part of the name, so processes running another version never share a file
+        layout = repr([(metric.name, metric.labels, metric.width) for metric in self.metrics])
+        digest = hashlib.blake2b(layout.encode(), digest_size=6).hexdigest()
+        return f"{settings.METRICS_FILE or shared_memory_path('imgpush-metrics')}.{digest}"
+
+    def _open(self):
+        if self._fd is not None:
+            # inherited from the parent, which keeps its slab: a child holds no lock to release
+            os.close(self._fd)
+            self._fd = None
+        self._values = None
+        self._slab = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        if settings.DISABLE_METRICS:
+            return
+        length = MAX_PROCESSES * self.size * DOUBLE
+        try:
+            fd = os.open(self.path(), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                # growing a file never clears the values already in it
+                if os.fstat(fd).st_size < length:
+                    os.ftruncate(fd, length)
+                values = memoryview(mmap.mmap(fd, length)).cast("d")
+            except BaseException:
+                os.close(fd)
+                raise
+        except OSError as e:
+            logger.warning(f"Metrics are not recorded, failed to open {self.path()}: {e}")
+            return
+        # the fd stays open, closing any fd of the file would release the lock on the slab
+        self._fd = fd
+        self._values = values
+
+    def _claim(self):
+        for slab in range(MAX_PROCESSES):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slab * self.size * DOUBLE)
+            except OSError:
+                continue
+            self._slab = slab * self.size
+            self._values[self._slab] = 1
+            return
+        logger.warning(f"Metrics are not recorded, all {MAX_PROCESSES} slabs are claimed")
+        self._values = None
+
+    def _ensure_open(self):
+        # opened lazily in every process, a forked worker claims a slab of its own
+        if self._pid != os.getpid():
+            with _open_lock:
+                if self._pid != os.getpid():
+                    self._open()
+
+    def add(self, index: int, amount: float):
+        self._ensure_open()
+        if self._values is None:
+            return
+        with self._lock:
+            if self._slab is None:
+                self._claim()
+                if self._values is None:
+                    return
+            self._values[self._slab + index] += amount
+
+    def totals(self) -> list[float]:
+        """
+        Returns the sum of every value over the slabs of all processes.
+        """
+        self._ensure_open()
+        totals = [0.0] * self.size
+        if self._values is None:
+            return totals
+        for start in range(0, len(self._values), self.size):
+            if self._values[start]:
+                totals = [total + value for total, value in zip(totals, self._values[start:start + self.size])]
+        return totals
+
+    def expose(self) -> str:
+        """
+        The expose function renders every metric in the Prometheus text format.
+
+        :return: The metrics of all worker processes
+        """
+        totals = self.totals()
+        return "".join("\n".join(metric.expose(totals)) + "\n" for metric in self.metrics)
+
+
+registry = Registry()
+
+
+def _format(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def _labels(pairs) -> str:
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+    # values per combination of labels
+    width = 1
+
+    def __init__(self, name: str, documentation: str, labels: dict[str, tuple] | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.series = list(itertools.product(*self.labels.values()))
+        self._series_index = {values: index for index, values in enumerate(self.series)}
+        self.offset = registry.register(self, len(self.series) * self.width)
+
+    def _index(self, labels: dict) -> int:
+        values = tuple(labels[name] for name in self.labels)
+        return self.offset + self._series_index[values] * self.width
+
+    def expose(self, totals: list[float]) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for index, values in enumerate(self.series):
+            lines += self._expose_series(totals, self.offset + index * self.width, list(zip(self.labels, values)))
+        return lines
+
+    def _expose_series(self, totals: list[float], index: int, pairs: list) -> list[str]:
+        return [f"{self.name}{_labels(pairs)} {_format(totals[index])}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        registry.add(self._index(labels), amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    # a count per bucket, the +Inf bucket and the sum
+    width = len(BUCKETS) + 2
+
+    def observe(self, value: float, **labels):
+        index = self._index(labels)
+        registry.add(index + bisect.bisect_left(BUCKETS, value), 1)
+        registry.add(index + len(BUCKETS) + 1, value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _expose_series(self, totals: list[float], index: int, pairs: list) -> list[str]:
+        lines = []
+        count = 0.0
+        for bucket, bound in enumerate((*BUCKETS, float("inf"))):
+            count += totals[index + bucket]
+            lines.append(f"{self.name}_bucket{_labels(pairs + [('le', _format(bound))])} {_format(count)}")
+        lines.append(f"{self.name}_sum{_labels(pairs)} {_format(totals[index + len(BUCKETS) + 1])}")
+        lines.append(f"{self.name}_count{_labels(pairs)} {_format(count)}")
+        return lines
+
+
+REQUESTS = Counter("imgpush_requests_total", "Requests handled, by endpoint and status class",
+                   {"endpoint": ENDPOINTS, "status": ("2xx", "3xx", "4xx", "5xx")})
+REQUEST_SECONDS = Histogram("imgpush_request_duration_seconds",
+                            "Time to produce a response, streamed bodies are not included",
+                            {"endpoint": ENDPOINTS})
+STAGE_SECONDS = Histogram("imgpush_stage_duration_seconds", "Time spent in each stage of uploads and image requests",
+                          {"stage": STAGES})
+CACHE_REQUESTS = Counter("imgpush_cache_requests_total",
+                         "Lookups in the in-memory image cache, the pregenerated variants and the resized image cache",
+                         {"cache": ("memory", "variants", "resized"), "result": ("hit", "miss")})
+RESIZE_TIMEOUTS = Counter("imgpush_resize_timeouts_total", "Resizes killed after RESIZE_TIMEOUT")
+RESIZE_REJECTED = Counter("imgpush_resize_rejected_total", "Resizes rejected because the resize queue was full")
+AUTODEL_SECONDS = Histogram("imgpush_autodel_cache_duration_seconds", "Time of the resized image cache eviction runs")
+AUTODEL_FILES = Counter("imgpush_autodel_cache_evicted_files_total", "Files deleted from the resized image cache")
+AUTODEL_BYTES = Counter("imgpush_autodel_cache_evicted_bytes_total", "Bytes deleted from the resized image cache")
+DEDUP_UPLOADS = Counter("imgpush_dedup_uploads_total",
+                        "Uploads stored with DEDUPLICATE_UPLOADS, as a new blob or as an alias of the blob "
+                        "of the same file or of the same encoded image",
+                        {"result": ("new", "same_file", "same_image")})
+
+
+def stage(name: str):
+    """
+    The stage function times a stage of an upload or image request,
+    as a context manager.
+
+    :param name: str: One of STAGES
+    """
+    return STAGE_SECONDS.time(stage=name)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def observe_request(endpoint: str | None, status: int, seconds: float):
+    """
+    The observe_request function counts a handled request and records its latency.
+
+    :param endpoint: str | None: The flask endpoint of the request, None when no route matched
+    :param status: int: The status code of the response
+    :param seconds: float: The time taken to produce the response
+    """
+    endpoint = (endpoint or "").rpartition(".")[2]
+    if endpoint not in ENDPOINTS:
+        endpoint = "other"
+    REQUESTS.inc(endpoint=endpoint, status=f"{min(max(status // 100, 2), 5)}xx")
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
@@ -1,35 +1,19 @@
 import logging
-from pymongo import MongoClient
-import gridfs
 import os
-import mimetypes
 import sys
 
 if __name__ == "__main__":
     myDir = os.getcwd()
     sys.path.append(myDir)
-import imgpush.settings as settings
+from imgpush.lib.migrate.migrate import migrate
 
-client: MongoClient = MongoClient(settings.MONGO_URI)
-db = client["imgpush"]
-fs: gridfs.GridFS = gridfs.GridFS(db, "images")
 
-
-def file_to_mongo():
-    logging.info("Migrating from file to mongo")
-
-    files = os.listdir(settings.IMAGES_DIR)
-
-    if not files:
-        logging.info("No files found")
-        return
-
-    for file in os.listdir(settings.IMAGES_DIR):
-        mimetype = mimetypes.guess_type(file)[0]
-        if not fs.exists(file):
-            logging.info(f"Migrating file {file}")
-            fs.put(open(f"{settings.IMAGES_DIR}{file}", "rb"), filename=file, metadata={"type": mimetype})
-            os.remove(f"{settings.IMAGES_DIR}{file}")
+def file_to_mongo(**kwargs) -> bool:
+    """
+    The file_to_mongo function moves the images in IMAGES_DIR to GridFS, see migrate.
+    """
+    return migrate("mongo", **kwargs)
 
 if __name__ == "__main__":
-    file_to_mongo()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(0 if file_to_mongo() else 1)
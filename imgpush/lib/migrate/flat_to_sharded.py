@@ -0,0 +1,39 @@
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    myDir = os.getcwd()
+    sys.path.append(myDir)
+import imgpush.settings as settings
+from imgpush.lib.filename import get_shard_path
+
+
+def flat_to_sharded(directory: str):
+    """
+    The flat_to_sharded function moves the files stored directly in directory
+    into the sharded layout. Every move is a rename within the same filesystem,
+    and lookups fall back to the flat path, so it can run while imgpush is serving.
+
+    :param directory: str: IMAGES_DIR, CACHE_DIR or VARIANTS_DIR
+    """
+    logging.info(f"Migrating {directory} to the sharded layout")
+
+    moved = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name.endswith((".tmp", ".lock")) or not entry.is_file():
+                continue
+            path = get_shard_path(directory, entry.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.rename(entry.path, path)
+            moved += 1
+
+    logging.info(f"Moved {moved} files in {directory}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for directory in (settings.IMAGES_DIR, settings.CACHE_DIR, settings.VARIANTS_DIR):
+        if os.path.isdir(directory):
+            flat_to_sharded(directory)
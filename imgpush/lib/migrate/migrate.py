@@ -0,0 +1,310 @@
+"""
+Moves the stored images between the local filesystem and GridFS.
+
+Images are copied concurrently, verified against the SHA-256 of their source
+and only then deleted from the source. Progress is checkpointed, so an
+interrupted migration resumes where it stopped. When every image has been
+moved, a marker recording the storage backend is written, which imgpush
+checks at startup. Images stored with DEDUPLICATE_UPLOADS are moved as
+separate copies, the blobs they shared are deleted at the end.
+
+    python imgpush/lib/migrate/migrate.py [--to mongo|file] [--workers 8] [--batch-size 100] [--dry-run]
+"""
+import argparse
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+if __name__ == "__main__":
+    myDir = os.getcwd()
+    sys.path.append(myDir)
+import gridfs
+from gridfs.errors import FileExists
+from pymongo import MongoClient
+from pymongo.collection import Collection
+import imgpush.settings as settings
+from imgpush.lib.dedup import BLOB_PREFIX, BLOBS_DIR, index
+from imgpush.lib.filename import find_path, get_shard_path, iter_files
+from imgpush.lib.utils import atomic_save
+
+# files in IMAGES_DIR, hidden from iter_files
+MARKER = ".storage"
+CHECKPOINT = ".migration-{}"
+CHUNK_SIZE = 1024 * 1024
+
+
+def read_marker() -> str | None:
+    try:
+        with open(os.path.join(settings.IMAGES_DIR, MARKER)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_marker(backend: str):
+    os.makedirs(settings.IMAGES_DIR, exist_ok=True)
+    with open(os.path.join(settings.IMAGES_DIR, MARKER), "w") as f:
+        f.write(backend)
+
+
+def check_marker(backend: str) -> bool:
+    """
+    The check_marker function checks at startup that the images were migrated
+    to the configured storage backend, without looking at the images themselves.
+
+    :param backend: str: "mongo" or "file"
+    :return: Whether the marker matches the backend
+    """
+    marker = read_marker()
+    if marker == backend:
+        return True
+    logging.warning(f"Images may still be stored in {'the filesystem' if backend == 'mongo' else 'GridFS'}, "
+                    f"run `python imgpush/lib/migrate/migrate.py --to {backend}` to migrate them")
+    return False
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _gridfs_digest(fs: gridfs.GridFS, file_id) -> str:
+    digest = hashlib.sha256()
+    grid_out = fs.get(file_id)
+    while chunk := grid_out.read(CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    An append-only log of the images that were migrated and deleted from the source.
+    """
+
+    def __init__(self, path: str, dry_run: bool):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f}
+        self._file = None if dry_run else open(path, "a")
+        self._lock = threading.Lock()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.done
+
+    def add(self, filename: str):
+        with self._lock:
+            self.done.add(filename)
+            if self._file:
+                self._file.write(filename + "\n")
+                self._file.flush()
+
+    def remove(self):
+        if self._file:
+            self._file.close()
+            os.remove(self.path)
+
+
+class Migration:
+    def __init__(self, fs: gridfs.GridFS, aliases: Collection, target: str, workers: int, batch_size: int,
+                 dry_run: bool):
+        self.fs = fs
+        self.aliases = aliases
+        self.target = target
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="migrate")
+        self.checkpoint = Checkpoint(os.path.join(settings.IMAGES_DIR, CHECKPOINT.format(target)), dry_run)
+        self.migrated = self.failed = self.size = 0
+        self._lock = threading.Lock()
+
+    def run(self) -> bool:
+        """
+        Migrates every image, returns whether all of them were migrated.
+        """
+        logging.info(f"Migrating images to {self.target}{' (dry run)' if self.dry_run else ''}")
+        batches = self._file_batches() if self.target == "mongo" else self._gridfs_batches()
+        for batch in batches:
+            # batches are processed one at a time to bound memory and queued work
+            list(self.executor.map(self._migrate_one, batch))
+        self.executor.shutdown()
+
+        verb = "Would migrate" if self.dry_run else "Migrated"
+        logging.info(f"{verb} {self.migrated} images ({self.size / 1024 / 1024:.1f} MB), {self.failed} failed")
+        if self.failed or self.dry_run:
+            return not self.failed
+        self.checkpoint.remove()
+        self._remove_blobs()
+        write_marker(self.target)
+        return True
+
+    def _remove_blobs(self):
+        # every alias was copied, the blobs of the source are not used anymore
+        if self.target == "mongo":
+            shutil.rmtree(BLOBS_DIR, ignore_errors=True)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(index.path + suffix):
+                    os.remove(index.path + suffix)
+            return
+        for grid_out in self.fs.find({"filename": {"$regex": f"^{BLOB_PREFIX.replace('.', '[.]')}"}}):
+            self.fs.delete(grid_out._id)
+
+    def _file_batches(self):
+        batch = []
+        for filename, path in iter_files(settings.IMAGES_DIR):
+            if filename in self.checkpoint:
+                continue
+            batch.append((filename, path))
+            if len(batch) >= self.batch_size:
+                yield self._with_existing(batch)
+                batch = []
+        if batch:
+            yield self._with_existing(batch)
+
+    def _with_existing(self, batch: list) -> list:
+        # one query per batch tells which images are already in GridFS
+        names = [filename for filename, _path in batch]
+        existing = {grid_out.filename: grid_out._id for grid_out in self.fs.find({"filename": {"$in": names}})}
+        return [(filename, path, existing.get(filename)) for filename, path in batch]
+
+    def _gridfs_batches(self):
+        batch = []
+        for grid_out in self.fs.find({}, batch_size=self.batch_size):
+            if grid_out.filename in self.checkpoint or grid_out.filename.startswith(BLOB_PREFIX):
+                continue
+            batch.append((grid_out.filename, grid_out._id, find_path(settings.IMAGES_DIR, grid_out.filename), False))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        # deduplicated images are copied from their blob
+        for alias in self.aliases.find({}, batch_size=self.batch_size):
+            blob = self.fs.find_one({"filename": BLOB_PREFIX + alias["blob"]})
+            if alias["_id"] in self.checkpoint or blob is None:
+                continue
+            batch.append((alias["_id"], blob._id, find_path(settings.IMAGES_DIR, alias["_id"]), True))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _migrate_one(self, item: tuple):
+        filename = item[0]
+        try:
+            size = self._to_mongo(*item) if self.target == "mongo" else self._to_file(*item)
+        except Exception as e:
+            logging.error(f"Failed to migrate {filename}: {e}")
+            size = None
+        with self._lock:
+            if size is None:
+                self.failed += 1
+            else:
+                self.migrated += 1
+                self.size += size
+
+    def _to_mongo(self, filename: str, path: str, existing_id) -> int | None:
+        size = os.path.getsize(path)
+        if self.dry_run:
+            logging.info(f"Would migrate {filename}{' (already in GridFS)' if existing_id else ''}")
+            return size
+
+        digest = _file_digest(path)
+        if existing_id is None:
+            try:
+                with open(path, "rb") as fp:
+                    existing_id = self.fs.put(fp, filename=filename, metadata={
+                        "type": mimetypes.guess_type(filename)[0],
+                        "uploadDate": datetime.fromtimestamp(os.path.getmtime(path)),
+                    })
+            except FileExists:
+                existing_id = self.fs.find_one({"filename": filename})._id
+
+        if _gridfs_digest(self.fs, existing_id) != digest:
+            logging.error(f"Checksum mismatch for {filename}, keeping the source")
+            return None
+        os.remove(path)
+        self.checkpoint.add(filename)
+        logging.info(f"Migrated {filename}")
+        return size
+
+    def _to_file(self, filename: str, file_id, existing_path: str | None, alias: bool) -> int | None:
+        grid_out = self.fs.get(file_id)
+        if self.dry_run:
+            logging.info(f"Would migrate {filename}{' (already in the filesystem)' if existing_path else ''}")
+            return grid_out.length
+
+        path = existing_path or get_shard_path(settings.IMAGES_DIR, filename)
+        if existing_path is None:
+            digest = hashlib.sha256()
+
+            def save(fp):
+                while chunk := grid_out.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    fp.write(chunk)
+
+            try:
+                atomic_save(path, save, exclusive=True)
+            except FileExistsError:
+                # created concurrently, the whole image was read before linking it
+                pass
+            source_digest = digest.hexdigest()
+        else:
+            source_digest = _gridfs_digest(self.fs, file_id)
+
+        if _file_digest(path) != source_digest:
+            logging.error(f"Checksum mismatch for {filename}, keeping the source")
+            return None
+        if alias:
+            # the blob may have other aliases, it is deleted once all of them are migrated
+            self.aliases.delete_one({"_id": filename})
+        else:
+            self.fs.delete(file_id)
+        self.checkpoint.add(filename)
+        logging.info(f"Migrated {filename}")
+        return grid_out.length
+
+
+def migrate(target: str, workers: int = 8, batch_size: int = 100, dry_run: bool = False) -> bool:
+    """
+    The migrate function moves every image to the target storage backend.
+
+    :param target: str: "mongo" to move images from IMAGES_DIR to GridFS, "file" for the opposite
+    :param workers: int: How many images are transferred concurrently
+    :param batch_size: int: How many images are checked for existence in one query
+    :param dry_run: bool: Only report what would be migrated
+    :return: Whether every image was migrated
+    """
+    if target == "file" and not settings.MONGO_URI:
+        logging.info("No MONGO_URI configured, nothing to migrate")
+        if not dry_run:
+            write_marker(target)
+        return True
+
+    client = MongoClient(settings.MONGO_URI)
+    try:
+        fs = gridfs.GridFS(client["imgpush"], "images")
+        return Migration(fs, client["imgpush"].aliases, target, workers, batch_size, dry_run).run()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Move the stored images between the filesystem and GridFS.")
+    parser.add_argument("--to", choices=["mongo", "file"], default="mongo" if settings.USE_MONGO else "file",
+                        help="the storage backend to migrate to, defaults to the configured one")
+    parser.add_argument("--workers", type=int, default=8, help="images transferred concurrently")
+    parser.add_argument("--batch-size", type=int, default=100, help="images checked for existence per query")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be migrated")
+    args = parser.parse_args()
+    sys.exit(0 if migrate(args.to, args.workers, args.batch_size, args.dry_run) else 1)
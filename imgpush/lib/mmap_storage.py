@@ -0,0 +1,171 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+from limits.storage import Storage
+from imgpush.lib.utils import shared_memory_path
+
+MAGIC = b"imgpush-limits-1"
+HEADER = struct.Struct("<16sQ")
+HEADER_SIZE = 64
+# blake2b digest of the key, counter, expiry as a unix timestamp
+SLOT = struct.Struct("<16sqd")
+EMPTY = bytes(16)
+DEFAULT_SLOTS = 1 << 18
+# slots probed for a key, the one closest to expiring is reused when all of them are live
+MAX_PROBES = 32
+
+_open_lock = threading.Lock()
+
+
+def default_uri() -> str:
+    """
+    Returns the uri of a counter file in /dev/shm, or in the temporary directory
+    where /dev/shm does not exist.
+    """
+    return f"mmap://{shared_memory_path('imgpush-ratelimit')}"
+
+
+class MmapStorage(Storage):
+    """
+    Rate limit storage for the fixed window strategy, in a hash table of counters
+    in a memory-mapped file. Every worker process on the host maps the same file,
+    and updates are serialized with a lock on the file, so limits are exact across
+    workers without a round trip to an external server.
+
+    The uri is mmap:///path/to/file, ?slots=N sets the size of a new table.
+    """
+
+    STORAGE_SCHEME = ["mmap"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        parsed = urlparse(uri)
+        self.path = parsed.path
+        self.slots = int(parse_qs(parsed.query).get("slots", [DEFAULT_SLOTS])[0])
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self) -> type[Exception] | tuple[type[Exception], ...]:
+        return OSError, ValueError
+
+    def _open(self):
+        # the file is opened lazily in every process, a forked worker drops the one it inherited
+        if self._fd is not None:
+            self._map.close()
+            os.close(self._fd)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(fd).st_size
+                header = os.pread(fd, HEADER.size, 0) if size >= HEADER_SIZE else b""
+                magic, slots = HEADER.unpack(header) if header else (None, 0)
+                if magic != MAGIC or size != HEADER_SIZE + slots * SLOT.size:
+                    slots = self.slots
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, HEADER_SIZE + slots * SLOT.size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, slots), 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, HEADER_SIZE + slots * SLOT.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.slots = slots
+        self._fd = fd
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        if self._pid != os.getpid():
+            with _open_lock:
+                if self._pid != os.getpid():
+                    self._lock = threading.Lock()
+                    self._open()
+        # the file lock excludes other processes, the thread lock other threads of this one
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield time.time()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _slot(self, digest: bytes, now: float) -> tuple[int, bool]:
+        """
+        Returns the offset of the slot of a key and whether it holds a live
+        counter of that key, or the offset of the slot to store it in.
+        """
+        home = int.from_bytes(digest[:8], "little")
+        victim, victim_expiry = None, float("inf")
+        for probe in range(min(MAX_PROBES, self.slots)):
+            offset = HEADER_SIZE + (home + probe) % self.slots * SLOT.size
+            slot_digest, _count, expiry = SLOT.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                return offset, expiry > now
+            if slot_digest == EMPTY:
+                # slots are never emptied, so the key is not further along
+                return (victim if victim_expiry <= now else offset), False
+            if expiry < victim_expiry:
+                victim, victim_expiry = offset, expiry
+        return victim, False
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        digest = self._digest(key)
+        with self._locked() as now:
+            offset, live = self._slot(digest, now)
+            if live:
+                _digest, count, expires = SLOT.unpack_from(self._map, offset)
+                count += amount
+                if elastic_expiry:
+                    expires = now + expiry
+            else:
+                count, expires = amount, now + expiry
+            SLOT.pack_into(self._map, offset, digest, count, expires)
+            return count
+
+    def get(self, key: str) -> int:
+        with self._locked() as now:
+            offset, live = self._slot(self._digest(key), now)
+            return SLOT.unpack_from(self._map, offset)[1] if live else 0
+
+    def get_expiry(self, key: str) -> float:
+        with self._locked() as now:
+            offset, live = self._slot(self._digest(key), now)
+            return SLOT.unpack_from(self._map, offset)[2] if live else now
+
+    def check(self) -> bool:
+        try:
+            with self._locked():
+                return True
+        except OSError:
+            return False
+
+    def reset(self) -> int | None:
+        with self._locked() as now:
+            cleared = 0
+            for offset in range(HEADER_SIZE, len(self._map), SLOT.size):
+                if SLOT.unpack_from(self._map, offset)[2] > now:
+                    cleared += 1
+            self._map[HEADER_SIZE:] = bytes(len(self._map) - HEADER_SIZE)
+            return cleared
+
+    def clear(self, key: str) -> None:
+        digest = self._digest(key)
+        with self._locked() as now:
+            offset, live = self._slot(digest, now)
+            if live:
+                # the slot keeps its key so the probe sequences going through it stay intact
+                SLOT.pack_into(self._map, offset, digest, 0, 0)
@@ -0,0 +1,199 @@
+import struct
+import zlib
+from PIL import ExifTags, Image
+
+# formats whose metadata can be stripped without decoding the image
+PASSTHROUGH_FORMATS = ("JPEG", "PNG", "WEBP")
+
+# JPEG segments kept besides the ones needed to decode the image: JFIF, ICC profile, Adobe color transform
+JPEG_APP0 = 0xE0
+JPEG_KEPT_APPS = {0xE2: b"ICC_PROFILE\x00", 0xEE: b"Adobe"}
+JPEG_SOS = 0xDA
+JPEG_EOI = b"\xff\xd9"
+JPEG_STANDALONE = {0x01, *range(0xD0, 0xD8)}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# ancillary PNG chunks that change how the image is rendered, every other one is metadata
+PNG_KEPT_CHUNKS = {b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT", b"bKGD", b"pHYs", b"acTL", b"fcTL", b"fdAT"}
+
+WEBP_METADATA_CHUNKS = (b"EXIF", b"XMP ")
+WEBP_FLAG_EXIF = 0x08
+WEBP_FLAG_XMP = 0x04
+
+
+def passthrough(img: Image.Image, data: bytes, file_format: str) -> bytes | None:
+    """
+    The passthrough function strips the metadata of an upload that is already
+    in the output format at the container level, so it can be stored without
+    being decoded and re-encoded. Only the Orientation tag of the EXIF data is kept.
+    Files that are not whole, e.g. truncated ones, are left to the decoder.
+
+    :param img: Image.Image: The opened, not yet decoded upload
+    :param data: bytes: The uploaded bytes
+    :param file_format: str: The output format
+    :return: The stripped image, or None if it has to be re-encoded
+    """
+    if img.format != file_format or file_format not in PASSTHROUGH_FORMATS:
+        return None
+    # browsers render CMYK JPEGs inconsistently, they are converted to RGB
+    if file_format == "JPEG" and img.mode not in ("L", "RGB"):
+        return None
+
+    orientation = get_orientation(img)
+    exif = orientation_exif(orientation) if orientation != 1 else None
+    try:
+        if file_format == "JPEG":
+            return strip_jpeg(data, exif)
+        if file_format == "PNG":
+            return strip_png(data, exif)
+        return strip_webp(data, exif)
+    except (ValueError, IndexError, struct.error):
+        # malformed containers are left to the decoder to reject
+        return None
+
+
+def get_orientation(img: Image.Image) -> int:
+    """
+    Returns the EXIF orientation of an image without decoding it.
+    """
+    if img.format != "PNG":
+        return img.getexif().get(ExifTags.Base.Orientation, 1)
+    # getexif decodes a PNG to look for an eXIf chunk after the image data, which the PNG spec does not allow
+    exif = Image.Exif()
+    if "exif" in img.info:
+        exif.load(img.info["exif"])
+    return exif.get(ExifTags.Base.Orientation, 1)
+
+
+def orientation_exif(orientation: int) -> bytes:
+    """
+    Returns a TIFF structure holding only the given Orientation tag.
+    """
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    return exif.tobytes()[len(b"Exif\x00\x00"):]
+
+
+def strip_jpeg(data: bytes, exif: bytes | None = None) -> bytes:
+    """
+    The strip_jpeg function drops the APPn and COM segments of a JPEG except
+    JFIF, ICC profile and Adobe ones, and copies the entropy coded data as is,
+    up to the EOI marker which a truncated JPEG lacks.
+
+    :param data: bytes: The JPEG
+    :param exif: bytes | None: TIFF structure to store in an Exif APP1 segment
+    :return: The stripped JPEG
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Missing JPEG SOI marker")
+
+    segments = []
+    pos = 2
+    while True:
+        if data[pos] != 0xFF:
+            raise ValueError("Expected a JPEG marker")
+        while data[pos] == 0xFF:
+            pos += 1
+        marker = data[pos]
+        start, pos = pos - 1, pos + 1
+        if marker in JPEG_STANDALONE:
+            segments.append((marker, data[start:pos]))
+            continue
+        (length,) = struct.unpack(">H", data[pos:pos + 2])
+        end = pos + length
+        if length < 2 or end > len(data):
+            raise ValueError("Truncated JPEG segment")
+        if marker == JPEG_SOS:
+            # 0xFF is always followed by 0x00 or a restart marker in entropy coded data
+            eoi = data.find(JPEG_EOI, end)
+            if eoi == -1:
+                raise ValueError("Missing JPEG EOI marker")
+            segments.append((marker, data[start:eoi + len(JPEG_EOI)]))
+            break
+        metadata = JPEG_APP0 < marker <= 0xEF or marker == 0xFE
+        if not metadata or (marker in JPEG_KEPT_APPS and data[pos + 2:end].startswith(JPEG_KEPT_APPS[marker])):
+            segments.append((marker, data[start:end]))
+        pos = end
+
+    if exif is not None:
+        payload = b"Exif\x00\x00" + exif
+        index = 1 if segments[0][0] == JPEG_APP0 else 0
+        segments.insert(index, (0xE1, b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload))
+    return b"\xff\xd8" + b"".join(segment for _, segment in segments)
+
+
+def _png_chunk(chunk_type: bytes, chunk_data: bytes) -> bytes:
+    return (struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data
+            + struct.pack(">I", zlib.crc32(chunk_type + chunk_data)))
+
+
+def strip_png(data: bytes, exif: bytes | None = None) -> bytes:
+    """
+    The strip_png function drops the ancillary chunks of a PNG that do not
+    affect rendering, such as text, time and eXIf chunks. The checksums of the
+    kept chunks are verified, so a corrupt PNG is rejected.
+
+    :param data: bytes: The PNG
+    :param exif: bytes | None: TIFF structure to store in an eXIf chunk
+    :return: The stripped PNG
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Missing PNG signature")
+
+    chunks = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while True:
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        end = pos + 12 + length
+        if end > len(data):
+            raise ValueError("Truncated PNG chunk")
+        if chunk_type == b"IDAT" and exif is not None:
+            # eXIf must come before the image data
+            chunks.append(_png_chunk(b"eXIf", exif))
+            exif = None
+        # chunks with an uppercase first letter are critical
+        if chunk_type[0] < 0x61 or chunk_type in PNG_KEPT_CHUNKS:
+            if zlib.crc32(data[pos + 4:end - 4]) != struct.unpack(">I", data[end - 4:end])[0]:
+                raise ValueError("Corrupt PNG chunk")
+            chunks.append(data[pos:end])
+        pos = end
+        if chunk_type == b"IEND":
+            return b"".join(chunks)
+
+
+def strip_webp(data: bytes, exif: bytes | None = None) -> bytes:
+    """
+    The strip_webp function drops the EXIF and XMP chunks of an extended WebP
+    and updates its feature flags. Simple WebPs cannot hold metadata.
+
+    :param data: bytes: The WebP
+    :param exif: bytes | None: TIFF structure to store in an EXIF chunk
+    :return: The stripped WebP
+    """
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        raise ValueError("Missing WebP header")
+
+    (riff_size,) = struct.unpack("<I", data[4:8])
+    if 8 + riff_size > len(data):
+        raise ValueError("Truncated WebP")
+    chunks = []
+    pos = 12
+    while pos < 8 + riff_size:
+        fourcc, length = struct.unpack("<4sI", data[pos:pos + 8])
+        end = pos + 8 + length + (length & 1)
+        if pos + 8 + length > len(data):
+            raise ValueError("Truncated WebP chunk")
+        if fourcc not in WEBP_METADATA_CHUNKS:
+            chunks.append(bytearray(data[pos:end]))
+        pos = end
+
+    if chunks[0][:4] != b"VP8X":
+        return data
+    flags = chunks[0][8] & ~(WEBP_FLAG_EXIF | WEBP_FLAG_XMP)
+    if exif is not None:
+        flags |= WEBP_FLAG_EXIF
+        chunks.append(bytearray(b"EXIF" + struct.pack("<I", len(exif)) + exif + b"\x00" * (len(exif) & 1)))
+    chunks[0][8] = flags
+
+    body = b"WEBP" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
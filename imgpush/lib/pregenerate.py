@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import imgpush.settings as settings
+from imgpush.lib.db import find_file, fs, variantsfs
+from imgpush.lib.errors import ResizeQueueFull
+from imgpush.lib.filename import find_path, get_resized_filename, get_shard_path
+from imgpush.lib.resize_pool import resize_pool
+from imgpush.lib.utils import atomic_write
+
+# how many times a pregeneration waits for a free resize worker before giving up
+MAX_ATTEMPTS = 5
+
+
+def parse_size(size: str) -> tuple:
+    """
+    The parse_size function parses a WxH preset such as "64x64" or "320x"
+    into a (width, height) tuple, using "" for a missing side like get_image does.
+
+    :param size: str: The size preset
+    :return: A (width, height) tuple
+    """
+    width, height = size.lower().split("x")
+    return int(width) if width else "", int(height) if height else ""
+
+
+SIZES = [parse_size(size) for size in settings.PREGENERATE_SIZES]
+
+executor = ThreadPoolExecutor(max_workers=settings.PREGENERATE_WORKERS, thread_name_prefix="pregenerate")
+
+
+def is_pregenerated(width, height) -> bool:
+    """
+    Whether variants of the given size are generated at upload time.
+    """
+    return (width, height) in SIZES
+
+
+def pregenerate(filename: str, source: str | bytes | None, mimetype: str, stored_as: str | None = None):
+    """
+    The pregenerate function queues the generation of every PREGENERATE_SIZES
+    variant of an uploaded image, without waiting for it.
+
+    :param filename: str: The filename of the uploaded image
+    :param source: str | bytes | None: The path of the uploaded image, its contents,
+        or None to read it back from GridFS in the background
+    :param mimetype: str: The mimetype of the uploaded image
+    :param stored_as: str | None: The GridFS filename of the image, when it is not filename
+    """
+    if SIZES and settings.DISABLE_RESIZE is not True:
+        executor.submit(_pregenerate, filename, source, mimetype, stored_as)
+
+
+def _pregenerate(filename: str, source: str | bytes | None, mimetype: str, stored_as: str | None = None):
+    extension = os.path.splitext(filename)[1][1:]
+    if source is None:
+        source = find_file(fs, stored_as or filename).read()
+    for width, height in SIZES:
+        resized_filename = get_resized_filename(filename, width, height)
+        try:
+            data = _resize(source, width, height, extension)
+            if settings.USE_MONGO:
+                variantsfs.put(data, filename=resized_filename,
+                               metadata={"type": mimetype, "original": filename, "uploadDate": datetime.now()})
+            else:
+                atomic_write(get_shard_path(settings.VARIANTS_DIR, resized_filename), data)
+            logging.info(f"Pregenerated {resized_filename}")
+        except Exception as e:
+            logging.error(f"Failed to pregenerate {resized_filename}: {e}")
+
+
+def _resize(source: str | bytes, width, height, extension: str) -> bytes:
+    for _ in range(MAX_ATTEMPTS - 1):
+        try:
+            return resize_pool.resize(source, width, height, extension)
+        except ResizeQueueFull:
+            time.sleep(settings.RESIZE_TIMEOUT)
+    return resize_pool.resize(source, width, height, extension)
+
+
+def delete_variants(filename: str):
+    """
+    The delete_variants function deletes the pregenerated variants of an image.
+
+    :param filename: str: The filename of the original image
+    """
+    if settings.USE_MONGO:
+        for variant in variantsfs.find({"metadata.original": filename}):
+            variantsfs.delete(variant._id)
+        return
+    for width, height in SIZES:
+        path = find_path(settings.VARIANTS_DIR, get_resized_filename(filename, width, height))
+        if path:
+            os.remove(path)
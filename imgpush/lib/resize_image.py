@@ -1,8 +1,21 @@
+import math
 from PIL import Image
-import imgpush.settings as settings
-import timeout_decorator
 
-def resize_image(img: Image.Image, width, height):
+# Pillow first shrinks the image with reduce() down to this many times the
+# target size, then resamples the rest, which is much cheaper for big downscales
+REDUCING_GAP = 3.0
+
+
+def get_target_size(img: Image.Image, width, height) -> tuple[int, int]:
+    """
+    The get_target_size function fills in a missing width or height
+    from the aspect ratio of the image.
+
+    :param img: Image.Image: The source image
+    :param width: The requested width, or "" to keep the aspect ratio
+    :param height: The requested height, or "" to keep the aspect ratio
+    :return: The (width, height) of the output image
+    """
     current_aspect_ratio = img.width / img.height
 
     if not width:
@@ -11,28 +24,61 @@ def resize_image(img: Image.Image, width, height):
     if not height:
         height = int(width / current_aspect_ratio)
 
+    return max(width, 1), max(height, 1)
+
+
+def get_crop_box(img_width: int, img_height: int, width: int, height: int) -> tuple[float, float, float, float]:
+    """
+    The get_crop_box function returns the centered region of the source
+    image that has the aspect ratio of the requested size.
+
+    :return: The (left, top, right, bottom) box in source coordinates
+    """
+    current_aspect_ratio = img_width / img_height
     desired_aspect_ratio = width / height
 
-    # Crop the image to fit the desired AR
     if desired_aspect_ratio > current_aspect_ratio:
-        newheight = int(img.width / desired_aspect_ratio)
-        img.crop(
-            (0, int((img.height / 2) - (newheight / 2)), img.width, int((img.height / 2) + (newheight / 2)))
-        )
-    else:
-        newwidth = int(img.height * desired_aspect_ratio)
-        img.crop(
-            (int((img.width / 2) - (newwidth / 2)), 0, int((img.width / 2) + (newwidth / 2)), img.height)
-        )
-
-    @timeout_decorator.timeout(settings.RESIZE_TIMEOUT, use_signals=False)
-    def resize(img, width, height):
-        return img.resize((width, height))
-
-    try:
-        resized = resize(img, width, height)
-        img = resized
-    except timeout_decorator.TimeoutError:
-        pass
-
-    return img
+        newheight = img_width / desired_aspect_ratio
+        top = (img_height - newheight) / 2
+        return 0, top, img_width, top + newheight
+
+    newwidth = img_height * desired_aspect_ratio
+    left = (img_width - newwidth) / 2
+    return left, 0, left + newwidth, img_height
+
+
+def plan_resize(img: Image.Image, width, height) -> tuple[tuple[int, int], tuple[float, float, float, float]]:
+    """
+    The plan_resize function computes the output size of a resize and the box of
+    the source image it is taken from. JPEGs are set up to be downscaled by their
+    decoder, so the plan must be made before the image is loaded.
+
+    :param img: Image.Image: The source image, not loaded yet
+    :param width: The requested width, or ""
+    :param height: The requested height, or ""
+    :return: The (width, height) of the output image and the box in the coordinates of the decoded image
+    """
+    width, height = get_target_size(img, width, height)
+    left, top, right, bottom = get_crop_box(img.width, img.height, width, height)
+
+    # Let the JPEG decoder downscale by a power of two while decoding,
+    # keeping the cropped region at least as large as the output
+    if img.format == "JPEG":
+        original_width, original_height = img.size
+        img.draft(img.mode, (
+            math.ceil(width * original_width / (right - left)),
+            math.ceil(height * original_height / (bottom - top)),
+        ))
+        scale_x, scale_y = img.width / original_width, img.height / original_height
+        left, right = left * scale_x, right * scale_x
+        top, bottom = top * scale_y, bottom * scale_y
+
+    return (width, height), (left, top, right, bottom)
+
+
+def resize_planned(img: Image.Image, size: tuple[int, int], box: tuple[float, float, float, float]) -> Image.Image:
+    return img.resize(size, box=box, reducing_gap=REDUCING_GAP)
+
+
+def resize_image(img: Image.Image, width, height):
+    return resize_planned(img, *plan_resize(img, width, height))
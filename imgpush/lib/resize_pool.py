@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from io import BytesIO
+from PIL import ExifTags, Image, ImageOps
+import imgpush.settings as settings
+from imgpush.lib.animation import ANIMATION_FORMATS, is_animated, save_animation
+from imgpush.lib.convert_format import convert_format_type
+from imgpush.lib.errors import ResizeQueueFull, ResizeTimeout
+from imgpush.lib import metrics
+from imgpush.lib.resize_image import plan_resize, resize_image, resize_planned
+from imgpush.lib.utils import pil_to_binary
+
+logger = logging.getLogger(__name__)
+
+# worker processes are forked so they do not re-import the app module
+context = multiprocessing.get_context("fork")
+
+# EXIF orientations that swap width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+# seconds between the checks of an idle worker for a dead parent
+ORPHAN_CHECK_INTERVAL = 1
+
+
+def _resize(source: str | bytes, width, height, file_format: str) -> bytes:
+    """
+    Decodes, resizes and encodes one image. Runs inside a worker process.
+    """
+    start = time.perf_counter()
+    with Image.open(source if isinstance(source, str) else BytesIO(source)) as img:
+        file_format = convert_format_type(file_format)
+        if file_format in ANIMATION_FORMATS and is_animated(img):
+            buffer = BytesIO()
+            transform = (lambda frame: resize_image(frame, width, height)) if width or height else None
+            # frames are decoded, resized and encoded one at a time
+            with metrics.stage("resize"):
+                save_animation(img, buffer, file_format, transform, variant=True)
+            return buffer.getvalue()
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+        # without a size the image is only converted to file_format
+        if width or height:
+            # the image is transposed after resizing, so sizes are given for the stored orientation
+            if orientation in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            size, box = plan_resize(img, width, height)
+        img.load()
+        metrics.observe_stage("decode", time.perf_counter() - start)
+        if width or height:
+            with metrics.stage("resize"):
+                img = ImageOps.exif_transpose(resize_planned(img, size, box))
+        elif orientation != 1:
+            # converted images lose the Orientation tag that passthrough uploads keep
+            img = ImageOps.exif_transpose(img)
+        with metrics.stage("encode"):
+            return pil_to_binary(img, file_format, variant=True)
+
+
+def _work(conn, parent: int):
+    # the handlers of the server's worker would keep this process alive when it is terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            # workers forked later hold the other end of this pipe too, so a dead parent does not close it
+            while not conn.poll(ORPHAN_CHECK_INTERVAL):
+                if os.getppid() != parent:
+                    return
+            job = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, _resize(*job)))
+        except Exception as e:
+            conn.send((False, repr(e)))
+
+
+class _Worker:
+    def __init__(self):
+        self.conn, child_conn = context.Pipe()
+        # gevent's socketpair is non-blocking, the connections expect blocking reads
+        for conn in (self.conn, child_conn):
+            os.set_blocking(conn.fileno(), True)
+        self.process = context.Process(target=_work, args=(child_conn, os.getpid()), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, job: tuple, timeout: float):
+        self.conn.send(job)
+        if not self.conn.poll(timeout):
+            raise ResizeTimeout
+        ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ResizePool:
+    """
+    A pool of worker processes that decode, resize and encode images.
+    At most `workers` jobs run at once and at most `queue_size` more wait
+    for a worker, further jobs are rejected with ResizeQueueFull. A worker
+    that exceeds the timeout is killed and replaced.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        # workers are started lazily, None marks a worker that has not been started yet
+        for _ in range(workers):
+            self._idle.put(None)
+
+    def resize(self, source: str | bytes, width, height, file_format: str) -> bytes:
+        """
+        The resize function resizes an image on one of the pool's workers.
+
+        :param source: str | bytes: The path of the image, or its contents
+        :param width: The requested width, or ""
+        :param height: The requested height, or ""
+        :param file_format: str: The format to encode the resized image in
+        :return: The encoded resized image
+        """
+        if not self._slots.acquire(blocking=False):
+            metrics.RESIZE_REJECTED.inc()
+            raise ResizeQueueFull
+        try:
+            with metrics.stage("resize_wait"):
+                worker = self._idle.get()
+            try:
+                if worker is None:
+                    worker = _Worker()
+                return worker.run((source, width, height, file_format), self.timeout)
+            except ResizeTimeout:
+                metrics.RESIZE_TIMEOUTS.inc()
+                logger.warning(f"Resize worker timed out after {self.timeout}s, killing it")
+                worker.kill()
+                worker = None
+                raise
+            except (EOFError, OSError):
+                logger.warning("Resize worker died, replacing it")
+                if worker is not None:
+                    worker.kill()
+                worker = None
+                raise
+            finally:
+                self._idle.put(worker)
+        finally:
+            self._slots.release()
+
+
+def default_workers() -> int:
+    """
+    Returns the number of resize workers of a pool when RESIZE_WORKERS is not
+    set, the CPUs shared between the pools of the SERVER_WORKERS processes.
+    """
+    return max(1, (os.cpu_count() or 1) // (settings.SERVER_WORKERS or 1))
+
+
+resize_pool = ResizePool(
+    settings.RESIZE_WORKERS or default_workers(),
+    settings.RESIZE_QUEUE_SIZE,
+    settings.RESIZE_TIMEOUT,
+)
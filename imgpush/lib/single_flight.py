@@ -0,0 +1,71 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Exception | None = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same key within a process:
+    the first caller runs the function, later callers wait for it and
+    reuse its result (or its exception).
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive lock on path + ".lock" shared by every worker process
+    on the host, blocking until it is available. The lock file is removed on
+    release, so callers must check again whether their work was already done.
+    """
+    lock_path = f"{path}.lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,56 @@
+from flask import Response, request
+from gridfs import GridOut
+
+
+def _iter_gridout(file: GridOut, start: int, length: int):
+    """
+    Yields the bytes of a GridOut between start and start + length,
+    at most one GridFS chunk at a time, and closes the file when done.
+    """
+    try:
+        file.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = file.read(min(file.chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def stream_gridout(file: GridOut, mimetype: str) -> Response:
+    """
+    The stream_gridout function builds a streaming response for a GridFS file.
+    The file is sent chunk by chunk, so memory per request is bounded by the
+    GridFS chunk size. Single byte ranges (HTTP Range) are answered with 206.
+
+    :param file: GridOut: The GridFS file to send
+    :param mimetype: str: The content type of the response
+    :return: A streaming response object
+    """
+    length = file.length
+    start, stop = 0, length
+    status = 200
+
+    # multiple ranges are not supported, the whole file is sent instead
+    if request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            file.close()
+            return Response(status=416, headers={"Content-Range": f"bytes */{length}"})
+        start, stop = byte_range
+        status = 206
+
+    resp = Response(
+        _iter_gridout(file, start, stop - start),
+        status=status,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    resp.headers["Content-Length"] = str(stop - start)
+    resp.headers["Accept-Ranges"] = "bytes"
+    if status == 206:
+        resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    return resp
@@ -0,0 +1,187 @@
+import logging
+import os
+import time
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Callable
+import filetype
+from flask import Request
+from gridfs.errors import FileExists
+from PIL import Image, UnidentifiedImageError
+import imgpush.settings as settings
+from imgpush.lib.animation import ANIMATION_FORMATS, check_animation, is_animated, save_animation
+from imgpush.lib.convert_format import convert_format_type, convert_image
+from imgpush.lib import dedup
+from imgpush.lib.db import fs, put_file
+from imgpush.lib.errors import CollisionError
+from imgpush.lib import metrics
+from imgpush.lib.filename import get_random_filename, get_shard_path
+from imgpush.lib.passthrough import passthrough
+from imgpush.lib.pregenerate import pregenerate
+from imgpush.lib.remove_metadata import remove_metadata
+from imgpush.lib.utils import atomic_save, pil_to_binary, save_image
+
+# how many random names an upload tries before giving up
+MAX_NAME_ATTEMPTS = 5
+# bytes filetype needs to recognize every format it knows
+SNIFF_SIZE = 8192
+# formats Pillow can only write to seekable files, they are encoded in memory for GridFS
+SEEKING_FORMATS = ("TIFF",)
+
+Image.MAX_IMAGE_PIXELS = settings.MAX_IMAGE_PIXELS
+
+
+def spooled_file() -> SpooledTemporaryFile:
+    """
+    The spooled_file function returns a buffer for an upload, kept in memory up
+    to UPLOAD_SPOOL_MB and only spilled to a temporary file beyond that.
+    """
+    return SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_MB * 1024 * 1024)
+
+
+class SpooledRequest(Request):
+    """
+    A request whose uploaded files are spooled in memory, werkzeug writes
+    every file larger than 500 KB to a temporary file by default.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spooled_file()
+
+
+def open_image(stream: BinaryIO) -> Image.Image:
+    """
+    Opens an upload without decoding it, some decoders such as WebP's already
+    reject truncated files here.
+    """
+    try:
+        return Image.open(stream)
+    except UnidentifiedImageError:
+        raise
+    except OSError as e:
+        raise UnidentifiedImageError(f"Failed to open image: {e}") from e
+
+
+def store_upload(stream: BinaryIO, name: str) -> str:
+    """
+    The store_upload function sniffs, decodes and re-encodes an uploaded image
+    exactly once, writing the encoded image straight into its destination file
+    or GridFS document. Uploads already in the output format are stored without
+    being decoded when PASSTHROUGH_UPLOADS is set, with their metadata stripped.
+    With DEDUPLICATE_UPLOADS, a file uploaded before is stored as an alias
+    without being decoded, see lib/dedup.py.
+
+    :param stream: BinaryIO: The seekable upload
+    :param name: str: The random name of the image, without extension
+    :return: The filename the image was stored under
+    """
+    with metrics.stage("sniff"):
+        head = stream.read(SNIFF_SIZE)
+        stream.seek(0)
+        output_type = settings.OUTPUT_TYPE or filetype.guess_extension(head)
+    if not output_type:
+        raise UnidentifiedImageError("Unknown file type")
+
+    source = None
+    if settings.DEDUPLICATE_UPLOADS:
+        source = dedup.source_key(stream, output_type)
+        filename = dedup.link_source(source, name, output_type.lower())
+        if filename:
+            return filename
+
+    output_filename = f"{name}.{output_type.lower()}"
+    file_format = convert_format_type(output_type)
+    with open_image(stream) as img:
+        if img.width * img.height > Image.MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError(f"Image has {img.width * img.height} pixels, "
+                                               f"more than the limit of {Image.MAX_IMAGE_PIXELS}")
+        check_animation(img)
+
+        if settings.PASSTHROUGH_UPLOADS:
+            stream.seek(0)
+            data = passthrough(img, stream.read(), file_format)
+            if data is not None:
+                return _store(output_filename, output_type, source, lambda fp: fp.write(data))
+
+        img = remove_metadata(img)
+        if file_format in ANIMATION_FORMATS and is_animated(img):
+            # frames are converted one at a time while they are encoded
+            return _store(output_filename, output_type, source, lambda fp: save_animation(img, fp, file_format))
+        with metrics.stage("decode"):
+            try:
+                img.load()
+            except OSError as e:
+                # truncated and corrupt files, e.g. those passthrough did not accept
+                raise UnidentifiedImageError(f"Failed to decode image: {e}") from e
+        if settings.USE_MONGO:
+            if file_format in SEEKING_FORMATS:
+                return _store(output_filename, output_type, source,
+                              lambda fp: fp.write(pil_to_binary(img, output_type)))
+            return _store(output_filename, output_type, source, lambda fp: save_image(img, fp, output_type))
+        with convert_image(img, file_format) as converted:
+            return _store(output_filename, output_type, source, lambda fp: save_image(converted, fp, file_format))
+
+
+def _store(filename: str, output_type: str, source: str | None, save: Callable[[BinaryIO], object]) -> str:
+    """
+    The _store function stores an upload under filename, or under another random
+    name if it is taken. The time spent in save is recorded as encoding, the rest
+    as writing to storage.
+
+    :param filename: str: The filename to store the image under
+    :param output_type: str: The type of the image
+    :param source: str | None: The key of the upload when it is deduplicated, see dedup.source_key
+    :param save: Callable: Writes the encoded image into the file object it is given
+    :return: The filename the image was stored under
+    """
+    encoding = 0.0
+
+    def timed_save(fp: BinaryIO):
+        nonlocal encoding
+        start = time.perf_counter()
+        try:
+            save(fp)
+        finally:
+            encoding += time.perf_counter() - start
+
+    start = time.perf_counter()
+    if source is not None:
+        filename = dedup.store(filename, f"image/{output_type}", timed_save, source)
+    else:
+        filename = _write(filename, output_type, timed_save)
+    metrics.observe_stage("encode", encoding)
+    metrics.observe_stage("storage_write", time.perf_counter() - start - encoding)
+    return filename
+
+
+def _write(filename: str, output_type: str, save: Callable[[BinaryIO], object]) -> str:
+    mimetype = f"image/{output_type}"
+    extension = os.path.splitext(filename)[1]
+    if settings.USE_MONGO:
+        for _ in range(MAX_NAME_ATTEMPTS):
+            try:
+                grid_in = put_file(fs, save, filename=filename,
+                                   metadata={"type": mimetype, "uploadDate": datetime.now()})
+                break
+            except FileExists:
+                filename = get_random_filename() + extension
+        else:
+            raise CollisionError
+        logging.info(f"Uploaded file {filename} with ObjectID({grid_in._id}) to GridFS")
+        pregenerate(filename, None, mimetype)
+        return filename
+
+    for _ in range(MAX_NAME_ATTEMPTS):
+        path = get_shard_path(settings.IMAGES_DIR, filename)
+        try:
+            # images from before the sharded layout may still be stored flat
+            if os.path.exists(os.path.join(settings.IMAGES_DIR, filename)):
+                raise FileExistsError
+            atomic_save(path, save, exclusive=True)
+            break
+        except FileExistsError:
+            filename = get_random_filename() + extension
+    else:
+        raise CollisionError
+    pregenerate(filename, path, mimetype)
+    return filename
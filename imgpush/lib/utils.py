@@ -1,52 +1,84 @@
-from typing import Optional
+from typing import BinaryIO, Callable
+from imgpush.lib.animation import ANIMATION_FORMATS, is_animated, save_animation
 from imgpush.lib.convert_format import convert_format_type
+from imgpush.lib.encode_options import prepare
 from imgpush.lib.errors import InvalidSize
 import imgpush.settings as settings
+import os
+import tempfile
+import threading
 from io import BytesIO
 from PIL import Image
 
-def pil_to_file(img: Image, file_format: str, fps: Optional[int] = None) -> BytesIO:
-    outfile = BytesIO()
-    if file_format.upper() == "GIF":
-        frames = []
-        try:
-            while 1:
-                img.seek(len(frames))
-                frames.append(img.copy())
-        except EOFError:
-            pass
+def save_image(img: Image.Image, fp: BinaryIO, file_format: str, variant: bool = False):
+    """
+    The save_image function encodes an image into a writable file object,
+    keeping every frame of animated GIFs and WebPs, with the encoding profile
+    of originals or of variants (see lib/encode_options.py).
+
+    :param img: Image.Image: The image to encode
+    :param fp: BinaryIO: Where to write the encoded image
+    :param file_format: str: The format to encode the image in
+    :param variant: bool: Whether the image is a resized or converted variant
+    """
+    file_format = convert_format_type(file_format)
+    if file_format in ANIMATION_FORMATS and is_animated(img):
+        save_animation(img, fp, file_format, variant=variant)
+        return
+
+    img, options = prepare(img, file_format, variant)
+    img.save(fp, format=file_format, **options)
 
-        delay = int(1000/fps) if fps else 100
-        frames[0].save(outfile, save_all=True, append_images=frames[1:], format="GIF", loop=0, duration=delay)
-    else:
-        img.save(outfile, format=convert_format_type(file_format))
-    # Reset the buffer cursor to the beginning of the buffer.
-    outfile.seek(0)
-    return outfile
+def pil_to_binary(img: Image.Image, file_format: str = "PNG", variant: bool = False):
+    binary_buffer = BytesIO()
+    save_image(img, binary_buffer, file_format, variant)
+    return binary_buffer.getvalue()
+
+def atomic_write(path: str, data: bytes, exclusive: bool = False):
+    """
+    The atomic_write function writes data to a temporary file next to path
+    and renames it into place, so readers never see a half-written file.
 
-def pil_to_binary(img: Image.Image, file_format: str = "PNG"):
-    if file_format.upper() == "GIF":
-        binary_buffer = BytesIO()
-        frames = []
-        try:
-            while True:
-                img.seek(len(frames))
-                frames.append(img.copy())
-        except EOFError:
-            pass
+    :param path: str: The destination path
+    :param data: bytes: The contents of the file
+    :param exclusive: bool: Raise FileExistsError instead of replacing an existing file
+    """
+    atomic_save(path, lambda fp: fp.write(data), exclusive)
 
-        if len(frames) > 1:
-            frames[0].save(binary_buffer, save_all=True, append_images=frames[1:], format="GIF")
+def atomic_save(path: str, save: Callable[[BinaryIO], object], exclusive: bool = False):
+    """
+    The atomic_save function is atomic_write for callers that encode straight
+    into the file, save is called with the temporary file opened for writing.
+
+    :param path: str: The destination path
+    :param save: Callable: Writes the contents of the file
+    :param exclusive: bool: Raise FileExistsError instead of replacing an existing file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as fp:
+            save(fp)
+        if exclusive:
+            # link fails if path exists, unlike a rename
+            os.link(tmp_path, path)
         else:
-            frames[0].save(binary_buffer, format="GIF")
-        binary_data = binary_buffer.getvalue()
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-        return binary_data
+def shared_memory_path(name: str) -> str:
+    """
+    The shared_memory_path function returns the path of a file in /dev/shm, or in
+    the temporary directory where /dev/shm does not exist, for files that worker
+    processes map into memory to share state.
 
-    binary_buffer = BytesIO()
-    img.save(binary_buffer, format=convert_format_type(file_format))
-    binary_data = binary_buffer.getvalue()
-    return binary_data
+    :param name: str: The name of the file
+    :return: The path of the file
+    """
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, name)
 
 def get_size_from_string(size):
     """
@@ -6,32 +6,77 @@ load_dotenv()
 
 PORT = 5000
 DEBUG = False
+SERVER_WORKERS = 0
+SERVER_WORKER_CLASS = "gthread"
+SERVER_THREADS = 8
+SERVER_WORKER_CONNECTIONS = 1000
+SERVER_PRELOAD = True
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
+SERVER_KEEPALIVE = 5
+SERVER_MAX_REQUESTS = 0
 IMAGES_DIR = "/images/"
 CACHE_DIR = "/cache/"
+VARIANTS_DIR = "/variants/"
 OUTPUT_TYPE = ""
 MAX_UPLOADS_PER_DAY = 1000
 MAX_UPLOADS_PER_HOUR = 100
 MAX_UPLOADS_PER_MINUTE = 20
+RATE_LIMIT_STORAGE_URI = ""
+METRICS_FILE = ""
 ALLOWED_ORIGINS = ["*"]
 NAME_STRATEGY = "randomstr"
-MAX_TMP_FILE_AGE = 5 * 60
+MAX_TMP_FILE_AGE = 24 * 60 * 60
+CACHE_MAX_SIZE_MB = 1024
+CACHE_MAX_ENTRIES = 0
 RESIZE_TIMEOUT = 5
+RESIZE_WORKERS = 0
+RESIZE_QUEUE_SIZE = 16
 JWT_PUBLIC_KEY = None
 JWT_ALGORITHM = None
 JWT_SECRET = None
 UPLOAD_REQUIRE_AUTH = False
 GET_REQUIRE_AUTH = False
+JWT_CACHE_SIZE = 1024
+JWT_CACHE_TTL = 300
 DISABLE_RESIZE = False
 DISABLE_URL_UPLOAD = False
 DISABLE_UPLOAD_FORM = False
+DISABLE_METRICS = False
 UPLOAD_ROUTE = "/"
+BATCH_UPLOAD_ROUTE = "/batch"
+MAX_BATCH_SIZE = 30
+BATCH_UPLOAD_WORKERS = 4
 IMAGES_ROOT = ""
 MONGO_URI = ""
 USE_MONGO = False
+MEMORY_CACHE_SIZE_MB = 0
+MEMORY_CACHE_MAX_ENTRY_KB = 1024
+
+NEGOTIATE_FORMATS = []
+CACHE_MAX_AGE = 31536000
+CACHE_IMMUTABLE = True
 
 VALID_SIZES = []
+PREGENERATE_SIZES = []
+PREGENERATE_WORKERS = 1
 
 MAX_SIZE_MB = 16
+UPLOAD_SPOOL_MB = 16
+MAX_IMAGE_PIXELS = 89478485
+MAX_ANIMATION_PIXELS = 500000000
+PASSTHROUGH_UPLOADS = True
+DEDUPLICATE_UPLOADS = False
+ORIGINAL_ENCODE_OPTIONS = {}
+VARIANT_ENCODE_OPTIONS = {}
+ADAPTIVE_ENCODING = False
+GRAPHIC_ENCODE_OPTIONS = {"WEBP": {"lossless": True}}
+
+FETCH_CONNECT_TIMEOUT = 5
+FETCH_READ_TIMEOUT = 10
+FETCH_TOTAL_TIMEOUT = 30
+FETCH_MAX_REDIRECTS = 3
+FETCH_POOL_SIZE = 4
 
 for variable in [item for item in globals() if not item.startswith("__")]:
     NULL = "NULL"
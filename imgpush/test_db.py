@@ -0,0 +1,67 @@
+import os
+import sys
+import gridfs
+import dotenv
+from pymongo import MongoClient, monitoring
+from gridfs.errors import FileExists
+
+dotenv.load_dotenv()
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+from imgpush.lib.db import ensure_indexes, find_file
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+counter = CommandCounter()
+client = MongoClient(os.getenv("MONGO_URI") or "mongodb://localhost", event_listeners=[counter])
+client.drop_database("imgpush_test")
+db = client["imgpush_test"]
+fs = gridfs.GridFS(db, "images")
+
+ensure_indexes(db)
+for collection in ("images.files", "cache.files", "variants.files"):
+    unique = [index for index in db[collection].list_indexes()
+              if index["key"] == {"filename": 1} and index.get("unique")]
+    if not unique:
+        raise Exception(f"Missing unique index on {collection}.filename")
+print("Indexes OK")
+
+fs.put(b"image data", filename="test.png", metadata={"type": "image/png"})
+try:
+    fs.put(b"other data", filename="test.png", metadata={"type": "image/png"})
+    raise Exception("Duplicate filename was stored")
+except FileExists:
+    print("Unique filename OK")
+
+counter.commands.clear()
+file = find_file(fs, "test.png")
+if counter.commands != ["find"]:
+    raise Exception(f"Expected a single find, got {counter.commands}")
+if file.metadata["type"] != "image/png" or file.length != len(b"image data"):
+    raise Exception("Wrong file found")
+print("Single round trip lookup OK")
+
+if file.read() != b"image data":
+    raise Exception("Wrong file content")
+print("Read OK")
+
+if find_file(fs, "missing.png") is not None:
+    raise Exception("Found a file that does not exist")
+print("Missing file OK")
+
+client.drop_database("imgpush_test")
@@ -0,0 +1,128 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+from imgpush.lib.errors import FetchError, FetchRejected
+from imgpush.lib.fetch import Fetcher
+
+buffer = BytesIO()
+Image.new("RGB", (64, 64), "red").save(buffer, format="JPEG")
+IMAGE = buffer.getvalue()
+MAX_SIZE = 64 * 1024
+
+connections = set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body: bytes, content_type: str = "image/jpeg", status: int = 200, headers: dict = {}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        connections.add(self.client_address)
+        if self.path == "/image.jpg":
+            self.send(IMAGE)
+        elif self.path == "/octet-stream":
+            self.send(IMAGE, "application/octet-stream")
+        elif self.path == "/html":
+            self.send(b"<html></html>", "text/html")
+        elif self.path == "/fake.jpg":
+            self.send(b"not an image" * 100)
+        elif self.path == "/large.jpg":
+            self.send(IMAGE + b"\0" * MAX_SIZE)
+        elif self.path == "/endless.jpg":
+            # no Content-Length, the size limit must abort the download
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(IMAGE)
+            for _ in range(1000):
+                self.wfile.write(b"\0" * 1024)
+        elif self.path == "/slow.jpg":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(IMAGE)))
+            self.end_headers()
+            self.wfile.write(IMAGE[:100])
+            self.wfile.flush()
+            time.sleep(2)
+        elif self.path == "/redirect":
+            self.send(b"", status=302, headers={"Location": "/image.jpg"})
+        elif self.path == "/loop":
+            self.send(b"", status=302, headers={"Location": "/loop"})
+        else:
+            self.send(b"", status=404)
+
+
+class Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # aborted downloads reset the connection while the handler is writing
+        pass
+
+
+server = Server(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = f"http://127.0.0.1:{server.server_port}"
+
+fetcher = Fetcher(max_size=MAX_SIZE, connect_timeout=1, read_timeout=0.5, total_timeout=5,
+                  max_redirects=3, pool_size=2, allow_private=True)
+
+
+def expect(exception, url: str, message: str):
+    try:
+        fetcher.fetch(url).close()
+    except exception:
+        print(message)
+        return
+    raise Exception(f"{url} did not raise {exception.__name__}")
+
+
+for _ in range(3):
+    if fetcher.fetch(f"{base}/image.jpg").read() != IMAGE:
+        raise Exception("Wrong image downloaded")
+print("Download OK")
+
+if len(connections) != 1:
+    raise Exception(f"Expected one reused connection, got {len(connections)}")
+print("Connection reuse OK")
+
+if fetcher.fetch(f"{base}/octet-stream").read() != IMAGE:
+    raise Exception("Wrong image downloaded")
+print("Generic content type OK")
+
+if fetcher.fetch(f"{base}/redirect").read() != IMAGE:
+    raise Exception("Wrong image downloaded after redirect")
+print("Redirect OK")
+
+expect(FetchRejected, f"{base}/loop", "Redirect limit OK")
+expect(FetchRejected, f"{base}/html", "Content type rejection OK")
+expect(FetchRejected, f"{base}/fake.jpg", "Magic bytes rejection OK")
+expect(FetchRejected, f"{base}/large.jpg", "Content-Length limit OK")
+expect(FetchRejected, f"{base}/endless.jpg", "Streaming size limit OK")
+expect(FetchError, f"{base}/slow.jpg", "Read timeout OK")
+expect(FetchError, f"{base}/missing.jpg", "Error status OK")
+expect(FetchRejected, "ftp://127.0.0.1/image.jpg", "Invalid scheme OK")
+
+fetcher.allow_private = False
+expect(FetchRejected, f"{base}/image.jpg", "Private address rejection OK")
+expect(FetchRejected, f"http://localhost:{server.server_port}/image.jpg", "Local hostname rejection OK")
+
+server.shutdown()
@@ -0,0 +1,53 @@
+import os
+import sys
+from io import BytesIO
+from PIL import ExifTags, Image
+
+myDir = os.getcwd()
+sys.path.append(myDir)
+
+from imgpush.lib.passthrough import passthrough
+from imgpush.lib.resize_pool import _resize
+
+
+def make_rotated_jpeg() -> bytes:
+    # stored landscape, displayed portrait
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+    buffer = BytesIO()
+    Image.new("RGB", (200, 100), "red").save(buffer, format="JPEG", exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+ROTATED = make_rotated_jpeg()
+
+for width, height, file_format, expected in [("", "", "WEBP", (100, 200)), ("", "", "PNG", (100, 200)),
+                                             (50, "", "WEBP", (50, 100)), ("", "", "JPEG", (100, 200))]:
+    with Image.open(BytesIO(_resize(ROTATED, width, height, file_format))) as img:
+        orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+        if img.size != expected or orientation != 1:
+            raise Exception(f"{width}x{height} {file_format}: got {img.size} with orientation {orientation}, "
+                            f"expected {expected}")
+print("Orientation OK")
+
+for file_format in ("JPEG", "PNG", "WEBP"):
+    buffer = BytesIO()
+    Image.effect_noise((256, 256), 64).convert("RGB").save(buffer, format=file_format)
+    data = buffer.getvalue()
+    with Image.open(BytesIO(data)) as img:
+        if passthrough(img, data, file_format) is None:
+            raise Exception(f"Whole {file_format} was not passed through")
+    corrupted = [data[:len(data) // 2], data[:-20]]
+    if file_format == "PNG":
+        # only PNG chunks have checksums
+        corrupted.append(data[:-100] + bytes(20) + data[-80:])
+    for corrupt in corrupted:
+        try:
+            img = Image.open(BytesIO(corrupt))
+        except OSError:
+            # rejected before passthrough
+            continue
+        with img:
+            if passthrough(img, corrupt, file_format) is not None:
+                raise Exception(f"Truncated or corrupt {file_format} was passed through")
+print("Passthrough integrity OK")
@@ -1,4 +1,88 @@
-from app import app
+"""
+Production entry point, runs the app on gunicorn's preforking server:
+
+    python imgpush/wsgi.py
+
+The SERVER_* settings choose the number of worker processes, threaded
+("gthread") or asynchronous ("gevent") workers, and whether the app is
+preloaded in the master. SIGHUP gracefully replaces the workers, SIGTERM
+lets them finish their requests before stopping. The app can also be served
+by any WSGI server as imgpush.wsgi:app.
+"""
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    myDir = os.getcwd()
+    sys.path.append(myDir)
+import imgpush.settings as settings
+
+if settings.SERVER_WORKER_CLASS == "gevent":
+    # patched before the app creates its locks, sockets and pools, also when it is preloaded
+    from gevent import monkey
+    monkey.patch_all()
+
+
+
+def load_app():
+    # imported on first use, the runner below only imports it in the workers unless it is preloaded
+    from imgpush.app import app
+    return app
+
+
+def __getattr__(name: str):
+    # imgpush.wsgi:app for other WSGI servers
+    if name == "app":
+        return load_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def gunicorn_options() -> dict:
+    """
+    The gunicorn_options function maps the SERVER_* settings to gunicorn settings.
+
+    :return: The settings of the gunicorn server
+    """
+    options = {
+        "bind": f"0.0.0.0:{settings.PORT}",
+        "workers": settings.SERVER_WORKERS,
+        "worker_class": settings.SERVER_WORKER_CLASS,
+        "preload_app": settings.SERVER_PRELOAD,
+        "timeout": settings.SERVER_TIMEOUT,
+        "graceful_timeout": settings.SERVER_GRACEFUL_TIMEOUT,
+        "keepalive": settings.SERVER_KEEPALIVE,
+        "max_requests": settings.SERVER_MAX_REQUESTS,
+        "max_requests_jitter": settings.SERVER_MAX_REQUESTS // 10,
+        "accesslog": "-" if settings.DEBUG else None,
+        "loglevel": "debug" if settings.DEBUG else "info",
+    }
+    if settings.SERVER_WORKER_CLASS == "gevent":
+        options["worker_connections"] = settings.SERVER_WORKER_CONNECTIONS
+    else:
+        options["threads"] = settings.SERVER_THREADS
+    return options
+
 
 if __name__ == "__main__":
-    app.run()
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options().items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # imported in the master when preloading, otherwise in every worker
+            return load_app()
+
+    # resolved before the app is imported, so the resize pools of the workers share the CPUs
+    settings.SERVER_WORKERS = settings.SERVER_WORKERS or os.cpu_count() or 1
+    from imgpush.lib.metrics import MAX_PROCESSES
+    from imgpush.lib.resize_pool import resize_pool
+
+    processes = settings.SERVER_WORKERS * (1 + resize_pool.workers)
+    if processes > MAX_PROCESSES and not settings.DISABLE_METRICS:
+        logging.warning(f"{processes} worker and resize processes exceed the {MAX_PROCESSES} that record metrics, "
+                        "lower SERVER_WORKERS or RESIZE_WORKERS")
+    Server().run()